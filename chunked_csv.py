@@ -0,0 +1,211 @@
+import numpy as np
+
+from time_codec import parse_time_characters
+
+# Helpers to handle a chunk of csv lines as whole columns, rather than splitting and joining every line in Python.
+# A chunk is encoded into a single byte buffer, after which the start and end of each field on each line are found with
+# array operations. Fields can then be compared, converted to numbers or joined into new lines as entire columns.
+#
+# The lines are handled in the same way as line.strip().split(","). Lines for which this cannot be guaranteed, which
+# are lines with whitespace at the edges, non-ascii characters or an unexpected number of fields, are marked as faulty.
+# It is up to the caller to handle those lines one by one.
+
+# The characters that are stripped from the edges of a line.
+_whitespace = np.zeros(256, dtype=bool)
+_whitespace[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = True
+
+# The characters that may occur in a number that is converted as a whole column, including the zero padding.
+_number_characters = np.zeros(256, dtype=bool)
+_number_characters[np.frombuffer(b"\x000123456789.-+eE", dtype=np.uint8)] = True
+
+
+# Split the given lines into fields.
+# Returns the byte buffer of the chunk, the start and end of every field as (lines x fields) arrays, and a mask of the
+# faulty lines. The fields of the faulty lines are all empty.
+def split_lines(lines, nr_fields, remove_quotes=False):
+    return split_text("".join(lines), len(lines), nr_fields, remove_quotes)
+
+
+# Split the given text, which holds the given number of lines, into fields in the same way as split_lines.
+def split_text(text, nr_lines, nr_fields, remove_quotes=False):
+    buffer = np.frombuffer((text + "\n").encode("utf-8"), dtype=np.uint8)
+    starts = np.zeros((nr_lines, nr_fields), dtype=np.int64)
+    ends = np.zeros((nr_lines, nr_fields), dtype=np.int64)
+    faulty, line_starts, line_ends = _find_lines(buffer, nr_lines)
+    if faulty.all():
+        return buffer, starts, ends, faulty
+
+    # Mark the lines that would change when stripped, and the lines with null or non-ascii characters.
+    faulty |= needs_stripping(buffer, line_starts, line_ends)
+    if buffer.max() >= 128 or not buffer.all():
+        faulty[np.searchsorted(line_ends, np.flatnonzero((buffer >= 128) | (buffer == 0)))] = True
+
+    if remove_quotes:
+        # Note that the quotes are removed after the lines have been checked, like line.strip().replace("\"", "").
+        buffer = buffer[buffer != ord("\"")]
+        _, line_starts, line_ends = _find_lines(buffer, nr_lines)
+
+    # Count the number of separators on each line, and find the separators of the lines that have the right amount.
+    separators = np.flatnonzero(buffer == ord(","))
+    first_separator = np.searchsorted(separators, line_starts)
+    counts = np.searchsorted(separators, line_ends) - first_separator
+    faulty |= counts != nr_fields - 1
+
+    valid = np.flatnonzero(~faulty)
+    line_separators = separators[first_separator[valid, None] + np.arange(nr_fields - 1)]
+    starts[valid, 0] = line_starts[valid]
+    starts[valid, 1:] = line_separators + 1
+    ends[valid, :-1] = line_separators
+    ends[valid, -1] = line_ends[valid]
+    return buffer, starts, ends, faulty
+
+
+# Find the start and end of each line in the buffer, in which every line ends with a newline.
+# If the buffer does not have the expected number of lines, all lines are marked as faulty.
+def _find_lines(buffer, nr_lines):
+    # The buffer always ends with an extra newline, which is an empty line if the last line already had one.
+    newlines = np.flatnonzero(buffer == ord("\n"))
+    if len(newlines) not in [nr_lines, nr_lines + 1]:
+        empty = np.zeros(nr_lines, dtype=np.int64)
+        return np.ones(nr_lines, dtype=bool), empty, empty
+
+    newlines = newlines[:nr_lines]
+    line_starts = np.concatenate(([0], newlines[:-1] + 1)).astype(np.int64)
+    return np.zeros(nr_lines, dtype=bool), line_starts, newlines
+
+
+# Check which of the given lines, given as spans of the buffer, are empty or have whitespace at their edges.
+# Note that this only covers the ascii whitespace that line.strip() removes.
+def needs_stripping(buffer, starts, ends):
+    is_empty = starts == ends
+    is_unstripped = is_empty.copy()
+    is_unstripped[~is_empty] |= _whitespace[buffer[starts[~is_empty]]] | _whitespace[buffer[ends[~is_empty] - 1]]
+    return is_unstripped
+
+
+# Get the characters of the given fields as a (fields x width) matrix, padded with zeros.
+def field_characters(buffer, starts, ends, width):
+    positions = starts[:, None] + np.arange(width)
+    characters = buffer[np.minimum(positions, len(buffer) - 1)]
+    characters[positions >= ends[:, None]] = 0
+    return characters
+
+
+# Check which of the given fields are equal to the given value.
+def fields_equal(buffer, starts, ends, value):
+    value = np.frombuffer(value, dtype=np.uint8)
+    return (ends - starts == len(value)) & (field_characters(buffer, starts, ends, len(value)) == value).all(axis=1)
+
+
+# Convert the given fields to floats, in the same way as float() would.
+# Returns the values and a mask of the fields that could not be converted.
+def fields_to_floats(buffer, starts, ends):
+    width = max(int((ends - starts).max(initial=0)), 1)
+    characters = field_characters(buffer, starts, ends, width)
+
+    # Only convert the fields that consist of the characters on which numpy and float() are known to agree.
+    faulty = ~_number_characters[characters].all(axis=1) | (ends == starts)
+    characters[faulty] = ord("0")
+    values, faulty_values = _to_floats(np.ascontiguousarray(characters).view("S" + str(width))[:, 0])
+    values[faulty] = np.nan
+    return values, faulty | faulty_values
+
+
+# Convert the given fields of at most 18 digits to integers, in the same way as int() would.
+# Returns the values and a mask of the fields that are not plain digits, which are left to int().
+def fields_to_ints(buffer, starts, ends):
+    width = min(max(int((ends - starts).max(initial=0)), 1), 18)
+    characters = field_characters(buffer, starts, ends, width).astype(np.int64)
+
+    # The fields are padded with zeros, so only the digits within the length of each field are added.
+    digits = characters - ord("0")
+    in_field = np.arange(width) < (ends - starts)[:, None]
+    faulty = (((digits < 0) | (digits > 9)) & in_field).any(axis=1) | (ends == starts) | (ends - starts > width)
+    values = np.zeros(len(starts), dtype=np.int64)
+    for i in range(0, width):
+        values = np.where(in_field[:, i], values * 10 + digits[:, i], values)
+    values[faulty] = 0
+    return values, faulty
+
+
+# Convert the given time fields to epoch seconds.
+# Returns the values and a mask of the fields that are not valid times in the fixed format.
+def fields_to_times(buffer, starts, ends):
+    timestamps, is_valid = parse_time_characters(field_characters(buffer, starts, ends, 19))
+    return timestamps, ~is_valid | (ends - starts != 19)
+
+
+# Convert the array of byte strings to floats, and mark the values that cannot be converted.
+# As such values are rare, we find them by converting ever smaller halves of the array.
+def _to_floats(values):
+    try:
+        return values.astype(np.float64), np.zeros(len(values), dtype=bool)
+    except ValueError:
+        if len(values) == 1:
+            return np.full(1, np.nan), np.ones(1, dtype=bool)
+
+        lesser_values, lesser_faulty = _to_floats(values[:len(values) // 2])
+        greater_values, greater_faulty = _to_floats(values[len(values) // 2:])
+        return np.concatenate((lesser_values, greater_values)), np.concatenate((lesser_faulty, greater_faulty))
+
+
+# Join the given fields into lines, which are each preceded by a newline.
+# The fields are given as a list of (buffer, starts, ends) columns, where each column is a span of the buffer.
+# Returns the joined lines as a string, and the end offset of each line in that string.
+def join_fields(columns):
+    output, line_ends = join_bytes(columns)
+    return output.tobytes().decode("utf-8"), line_ends
+
+
+# Join the given fields into lines in the same way as join_fields, but return the joined lines as utf-8 encoded bytes in
+# an array, next to the end offset of each line.
+def join_bytes(columns):
+    # Place the separators and all buffers after each other, such that every piece of a line is a span of one source.
+    sources = [np.frombuffer(b"\n,", dtype=np.uint8)]
+    offsets = {}
+    for buffer, _, _ in columns:
+        if id(buffer) not in offsets:
+            offsets[id(buffer)] = sum(len(source) for source in sources)
+            sources.append(buffer)
+    source = np.concatenate(sources)
+
+    # Every line consists of a newline, followed by the columns separated by commas.
+    nr_lines = len(columns[0][1])
+    if nr_lines == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64)
+
+    piece_starts = np.zeros((nr_lines, 2 * len(columns)), dtype=np.int64)
+    piece_lengths = np.ones((nr_lines, 2 * len(columns)), dtype=np.int64)
+    piece_starts[:, 2::2] = 1
+    for i, (buffer, starts, ends) in enumerate(columns):
+        piece_starts[:, 2 * i + 1] = starts + offsets[id(buffer)]
+        piece_lengths[:, 2 * i + 1] = ends - starts
+
+    # Gather all the characters of all the pieces in one go.
+    piece_starts = piece_starts.reshape(-1)
+    piece_lengths = piece_lengths.reshape(-1)
+    piece_offsets = np.cumsum(piece_lengths) - piece_lengths
+    positions = np.repeat(piece_starts - piece_offsets, piece_lengths) + np.arange(piece_lengths.sum())
+    line_ends = np.cumsum(piece_lengths.reshape(nr_lines, -1).sum(axis=1))
+    return source[positions], line_ends
+
+
+# Write the selected lines of a chunk to the output file, in their original order, and return the number of lines written.
+# The faulty lines are handed to the given function one by one, which typically hands them to the line loop of the
+# caller, such that they are handled in the original way. It returns the number of lines it has written.
+def write_rows(output, output_ends, keep, faulty, process_faulty_line, output_file):
+    if not faulty.any():
+        output_file.write(output)
+        return len(output_ends)
+
+    # The number of selected lines that precede each of the faulty lines.
+    nr_preceding = np.cumsum(keep)
+    nr_accepted = len(output_ends)
+    written = 0
+    for i in np.flatnonzero(faulty).tolist():
+        end = output_ends[nr_preceding[i] - 1] if nr_preceding[i] > 0 else 0
+        output_file.write(output[written:end])
+        written = end
+        nr_accepted += process_faulty_line(i)
+    output_file.write(output[written:])
+    return nr_accepted
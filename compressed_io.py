@@ -0,0 +1,156 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+import time
+
+# All stages read and write their csv files through open_input and open_output, such that both the raw inputs and the
+# intermediate files can be stored compressed. The codec is chosen from the extension of the file name, and files with
+# any other extension are plain text files that are opened as usual.
+#
+# All inputs are read in large blocks on a background thread, which keeps a bounded number of blocks ahead of the
+# parser. Reading from the network share and decompressing both release the GIL, so the round trips to the share and the
+# decompression overlap with the parsing done in the main thread. When the file is closed, we report how much time the
+# parser spent waiting for blocks, and how much time it spent on everything else.
+#
+# Measured on a synthetic sample of 17 MB of pre-processed taxi rows, on a single core. The speeds are in MB of csv per
+# second, and the sizes are relative to the plain csv file:
+#   codec   level   size   compress   decompress
+#   .gz     1       38%    58         138
+#   .gz     6       32%    19         145
+#   .bz2    9       21%    8          19
+#   .xz     1       25%    8          43
+#   .xz     6       21%    1          43
+# For the intermediate files .gz at level 1 is the best trade-off, as it cuts the traffic to the share to less than half
+# while both ends stay fast. The raw inputs can be stored as .xz to get the smallest files, but then decompression is
+# about as fast as parsing in the chunked pre-processing engine, which is why it runs on a separate thread.
+
+# The codec module for each of the compressed extensions.
+codecs = {".gz": gzip, ".bz2": bz2, ".xz": lzma}
+
+# The compression level used when writing each of the compressed extensions.
+compression_levels = {".gz": 1, ".bz2": 9, ".xz": 1}
+
+# The suffix that is added to the names of the intermediate files of all stages.
+# Use e.g. ".gz" to store all pre-processed, clustered and sorted files compressed, or "" to store them as plain csv.
+# The stages hold the names of their intermediate files without the suffix, and add it with intermediate_file whenever
+# they open or check a file, so the suffix can be set on this module at any time before the files are processed.
+intermediate_suffix = ""
+
+# The size of the blocks that are read (and decompressed) at once, and the number of blocks that is read ahead.
+# With two blocks the reader fills one block while the parser works on the other.
+block_size = 1 << 24
+read_ahead_blocks = 2
+
+# The size of the buffer from which the lines are decoded.
+line_buffer_size = 1 << 20
+
+# Whether to report the time spent waiting on I/O and parsing when an input file is closed.
+report_io_times = True
+
+
+# The name under which the given intermediate file is stored, with the intermediate_suffix as it is set now.
+def intermediate_file(filename):
+    return filename + intermediate_suffix
+
+
+# The extension of the codec of the given file, or None when the file is not compressed.
+def compression_of(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return extension if extension in codecs else None
+
+
+# Open the given file for reading lines, in text mode.
+# Plain files can be read from the given byte offset, which should be at the start of a line.
+# Files of which only the first few lines are read are better opened without reading ahead, which reads whole blocks.
+def open_input(filename, newline=None, offset=0, read_ahead=True):
+    extension = compression_of(filename)
+    if extension is None:
+        file = open(filename, "rb")
+        file.seek(offset)
+    elif offset == 0:
+        file = codecs[extension].open(filename, "rb")
+    else:
+        raise ValueError("Compressed file " + filename + " cannot be read from an offset")
+
+    if not read_ahead:
+        return io.TextIOWrapper(file, newline=newline)
+
+    reader = _BackgroundReader(file, filename)
+    return io.TextIOWrapper(io.BufferedReader(reader, line_buffer_size), newline=newline)
+
+
+# Open the given file for writing, in text mode.
+def open_output(filename, newline=None):
+    extension = compression_of(filename)
+    if extension is None:
+        return open(filename, "w", newline=newline)
+
+    if extension == ".xz":
+        return lzma.open(filename, "wt", preset=compression_levels[extension], newline=newline)
+    return codecs[extension].open(filename, "wt", compresslevel=compression_levels[extension], newline=newline)
+
+
+# A raw binary stream that reads the blocks of the given file on a background thread.
+class _BackgroundReader(io.RawIOBase):
+    def __init__(self, file, filename):
+        super().__init__()
+        self._filename = filename
+        self._blocks = queue.Queue(read_ahead_blocks)
+        self._stopped = threading.Event()
+        self._block = memoryview(b"")
+        self._at_end = False
+        self._opened_at = time.perf_counter()
+        self._waiting_time = 0.0
+        self._thread = threading.Thread(target=self._read_blocks, args=(file,), daemon=True)
+        self._thread.start()
+
+    def _read_blocks(self, file):
+        try:
+            with file:
+                for block in iter(lambda: file.read(block_size), b""):
+                    if not self._put(block):
+                        return
+            self._put(b"")
+        except Exception as e:
+            # Hand the error to the reading thread, which raises it.
+            self._put(e)
+
+    # Put the item in the queue, unless the reader is closed before there is room for it.
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self._block) == 0 and not self._at_end:
+            waiting_since = time.perf_counter()
+            block = self._blocks.get()
+            self._waiting_time += time.perf_counter() - waiting_since
+            if isinstance(block, Exception):
+                self._at_end = True
+                raise block
+            self._at_end = len(block) == 0
+            self._block = memoryview(block)
+
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        return size
+
+    def close(self):
+        if report_io_times and not self.closed:
+            parsing_time = time.perf_counter() - self._opened_at - self._waiting_time
+            print("Spent %.1fs waiting on I/O and %.1fs parsing %s" % (self._waiting_time, parsing_time, self._filename))
+        self._stopped.set()
+        super().close()
@@ -0,0 +1,65 @@
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+# The rows of the line engines refer to the same positions over and over again. The bike trips start and end at a few
+# hundred stations, and many taxi trips start and end at the same busy spots. Instead of parsing the coordinates and
+# looking them up for every row, the result for a position is cached, keyed on its raw longitude and latitude strings.
+# The cache is bounded and evicts the least recently used positions, such that the many distinct taxi positions cannot
+# make it grow without limit. For the bike data a lookup then comes down to a single dictionary hit.
+#
+# The chunked engines look up the distinct positions of a whole chunk at once, through a batch cache with the same
+# bound and eviction policy. The positions that are not cached yet are handed to a function as a single batch.
+
+# The maximum number of positions that is remembered by each cache.
+coordinate_cache_size = 1 << 16
+
+
+# Wrap the given function of a (longitude, latitude) string pair in a new, empty cache.
+def cache_coordinates(function):
+    return lru_cache(maxsize=coordinate_cache_size)(function)
+
+
+# The same statistics as those of functools.lru_cache.
+CacheInfo = namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+
+# A bounded cache of which the least recently used entries are evicted, that looks up many keys at once.
+class BatchCoordinateCache:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Get the values of all the given (distinct) keys. The values of the keys that are not cached are found by calling
+    # the given function with the indices of those keys, which returns their values in the same order.
+    def lookup(self, keys, function):
+        values = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            value = self.entries.get(key)
+            if value is None:
+                missing.append(i)
+            else:
+                self.entries.move_to_end(key)
+                values[i] = value
+
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing) > 0:
+            for i, value in zip(missing, function(missing)):
+                values[i] = value
+                self.entries[keys[i]] = value
+            while len(self.entries) > coordinate_cache_size:
+                self.entries.popitem(last=False)
+        return values
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, coordinate_cache_size, len(self.entries))
+
+
+# Report the number of hits and misses of the given cache, if it has been used at all.
+def report_cache(cache, name):
+    info = cache.cache_info()
+    if info.hits + info.misses > 0:
+        print("Looked up %d positions for %s with %d cache hits and %d misses, %d positions cached" %
+              (info.hits + info.misses, name, info.hits, info.misses, info.currsize))
@@ -1,16 +1,177 @@
+import hashlib
+import os
+from functools import lru_cache
+
 import fiona
-from shapely.geometry import Point, shape
-from pprint import pprint
+import numpy as np
+import shapely
 from dbfread import DBF
-import csv
+from shapely.geometry import shape
+
+# Assign the neighbourhood (district) to points, by joining them with the polygons of neighbourhoods.shp.
+# Testing every point against every polygon, and building the polygon again for every test, takes minutes for the
+# nodes of a deep tree. Instead, the polygons are read once, prepared, and put in an R-tree (STRtree), such that every
+# point is only tested against the few polygons whose bounding box contains it. All points of a batch are joined in one
+# query, which takes seconds for the 16k nodes at k = 14.
+#
+# A point gets a district when it lies within the polygon, i.e. not on its boundary, which is the same test as
+# point.within(polygon). Should a point be within several polygons, it gets the last one in the file, as the loop over
+# the polygons did. Points outside all polygons get the empty string.
+
+
+# A spatial index over the prepared polygons of the districts, with the names of the districts in the same order.
+class DistrictIndex:
+    def __init__(self, geometries, names):
+        self.geometries = np.array(geometries, dtype=object)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+        # The names, followed by the name for points outside all districts, which is thus found at index -1.
+        self.names = np.array(list(names) + [""], dtype=object)
+
+    # Get the names of the districts of all the given positions at once, given as arrays of longitudes and latitudes.
+    def find_districts(self, lon, lat):
+        return self.names[self.find_district_ids(lon, lat)].tolist()
+
+    # Get the index of the district of every given position, or -1 for positions outside all districts.
+    def find_district_ids(self, lon, lat):
+        points = shapely.points(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        point_indices, district_indices = self.tree.query(points, predicate="within")
+
+        # Take the last district that holds the point.
+        districts = np.full(len(points), -1, dtype=np.int64)
+        np.maximum.at(districts, point_indices, district_indices)
+        return districts
 
 
-def add_neighborhoods(nodes):
-    with fiona.open("neighbourhoods.shp") as f:
-        db = DBF("neighbourhoods.dbf")
+# Read the districts from the given shape file and its database file, of which the latter holds the names. The index of
+# every pair of files is only built once.
+@lru_cache(maxsize=None)
+def load_district_index(shape_filename, database_filename):
+    with fiona.open(shape_filename) as f:
+        db = DBF(database_filename)
 
+        geometries = []
+        names = []
         for multi, record in zip(f, db):
-            for node in nodes:
-                point = Point(node.lon, node.lat)
-                if point.within(shape(multi['geometry'])):
-                    nodes.district = record["Name"]
\ No newline at end of file
+            geometries.append(shape(multi['geometry']))
+            names.append(record["Name"])
+    return DistrictIndex(geometries, names)
+
+
+# Set the district of each of the given nodes, based on its center point.
+def add_neighborhoods(nodes, shape_filename="neighbourhoods.shp", database_filename="neighbourhoods.dbf"):
+    index = load_district_index(shape_filename, database_filename)
+    districts = index.find_districts([node.lon for node in nodes], [node.lat for node in nodes])
+
+    for node, district in zip(nodes, districts):
+        if district != "":
+            node.district = district
+
+
+# The districts of all trip endpoints are looked up in a raster over the square around New York that holds all valid
+# positions of pre_processing.is_valid_position. Every cell of the raster holds the index of the district it lies in, or
+# -1 when it lies outside all districts. Cells that are crossed by the boundary of a district do not have a single
+# district, and the positions in them are joined with the polygons as above. At the default cell size only a small
+# fraction of the positions falls in such cells, so the lookup of a whole column of positions is an index operation.
+#
+# Building the raster takes a while, so it is stored next to the shape file, under a name that holds a hash of the shape
+# file, the database file and the raster settings. A changed shape file thus gets a new raster.
+raster_center = (-74.00597, 40.71278)
+raster_radius = 2
+raster_cell_size = 0.001
+
+# The values of the cells outside all districts, and of the cells that need the exact test.
+_outside = -1
+_mixed = -2
+
+
+# The districts of a raster, on top of the index that is used for the mixed cells and the positions outside the raster.
+class DistrictRaster:
+    def __init__(self, index, cells):
+        self.index = index
+        self.names = index.names
+        self.cells = cells
+
+    # Get the names of the districts of all the given positions at once, given as arrays of longitudes and latitudes.
+    def find_districts(self, lon, lat):
+        return self.names[self.find_district_ids(lon, lat)].tolist()
+
+    # Get the index of the district of every given position, or -1 for positions outside all districts.
+    def find_district_ids(self, lon, lat):
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        rows, columns, in_raster = _cells_of(lon, lat, self.cells.shape[0])
+
+        districts = np.full(len(lon), _mixed, dtype=np.int64)
+        districts[in_raster] = self.cells[rows[in_raster], columns[in_raster]]
+
+        # Positions outside the raster, and not-a-number positions, are looked up exactly as well.
+        exact = np.flatnonzero(districts == _mixed)
+        if len(exact) > 0:
+            districts[exact] = self.index.find_district_ids(lon[exact], lat[exact])
+        return districts
+
+
+# Get the row and column of the cell of every position, and whether it lies in the raster of the given size.
+def _cells_of(lon, lat, size):
+    with np.errstate(invalid="ignore"):
+        rows = np.floor((lat - (raster_center[1] - raster_radius)) / raster_cell_size)
+        columns = np.floor((lon - (raster_center[0] - raster_radius)) / raster_cell_size)
+        in_raster = (rows >= 0) & (rows < size) & (columns >= 0) & (columns < size)
+    return np.where(in_raster, rows, 0).astype(np.int64), np.where(in_raster, columns, 0).astype(np.int64), in_raster
+
+
+# Assign every cell of the raster to a district of the given index.
+def build_district_raster(index):
+    size = int(np.ceil(2 * raster_radius / raster_cell_size))
+    cells = np.full((size, size), _outside, dtype=np.int16 if len(index.geometries) < 1 << 15 else np.int32)
+
+    # Only the cells in the bounds of the districts can hold a district, so only those are built, a row at a time.
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(index.geometries)
+    first_row, first_column, _ = _cells_of(np.array([max(min_lon, raster_center[0] - raster_radius)]),
+                                           np.array([max(min_lat, raster_center[1] - raster_radius)]), size)
+    last_row, last_column, _ = _cells_of(np.array([min(max_lon, raster_center[0] + raster_radius - 1e-9)]),
+                                         np.array([min(max_lat, raster_center[1] + raster_radius - 1e-9)]), size)
+    columns = np.arange(first_column[0], last_column[0] + 1)
+    boundaries = shapely.STRtree(shapely.boundary(index.geometries))
+
+    for row in range(first_row[0], last_row[0] + 1):
+        west = raster_center[0] - raster_radius + columns * raster_cell_size
+        south = raster_center[1] - raster_radius + row * raster_cell_size
+
+        # If no boundary crosses a cell, all positions in it lie in the same districts as its center. The cells are
+        # grown a little, such that positions that are rounded into a neighbouring cell are covered as well.
+        centers = index.find_district_ids(west + raster_cell_size / 2,
+                                          np.full(len(columns), south + raster_cell_size / 2))
+        margin = raster_cell_size * 1e-6
+        boxes = shapely.box(west - margin, south - margin, west + raster_cell_size + margin,
+                            south + raster_cell_size + margin)
+        centers[np.unique(boundaries.query(boxes, predicate="intersects")[0])] = _mixed
+        cells[row, columns] = centers
+    return cells
+
+
+# The name of the file in which the raster of the given shape and database files is stored.
+def district_raster_file(shape_filename, database_filename):
+    digest = hashlib.sha1(repr((raster_center, raster_radius, raster_cell_size)).encode("utf-8"))
+    for filename in [shape_filename, database_filename]:
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return os.path.splitext(shape_filename)[0] + "_raster_" + digest.hexdigest()[:16] + ".npy"
+
+
+# Read the raster of the given shape and database files, which is built and stored first if it does not exist yet.
+@lru_cache(maxsize=None)
+def load_district_raster(shape_filename, database_filename):
+    index = load_district_index(shape_filename, database_filename)
+    raster_filename = district_raster_file(shape_filename, database_filename)
+    if os.path.isfile(raster_filename):
+        return DistrictRaster(index, np.load(raster_filename))
+
+    print("Building the district raster of", shape_filename, "into", raster_filename)
+    cells = build_district_raster(index)
+    with open(raster_filename, "wb") as output_file:
+        np.save(output_file, cells)
+    return DistrictRaster(index, cells)
@@ -0,0 +1,204 @@
+import json
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+# Next to the nested json file, the median cluster tree is stored as a flat array of nodes in a .npy file.
+# The nodes are stored in pre-order, such that the root is node 0 and the lesser child directly follows its parent.
+# Every node holds the dimension it splits on (0 for the longitude, 1 for the latitude), its median and the indices of
+# its children. Leaves have no split dimension and children (-1), but do have a leaf id and a center.
+# The file is read with a single call, so loading it is much faster than parsing the nested json file.
+node_dtype = np.dtype([("split_dimension", np.int8), ("median", np.float64), ("lesser", np.int32),
+                       ("greater", np.int32), ("leaf_id", np.int32), ("center", np.float64, (2,))])
+
+
+# The name of the flat file that belongs to the given json tree file.
+def flat_tree_file(json_filename):
+    return os.path.splitext(json_filename)[0] + ".npy"
+
+
+# Convert a finalized tree, given as Node objects or as the namedtuples read from the json file, to a flat array.
+# A subtree is flattened on its own when the depth of its root is given, with the indices of its children counted from
+# its root.
+def flatten_tree(tree, depth=0):
+    nodes = []
+    _flatten_node(tree, depth, nodes)
+
+    flat_nodes = np.zeros(len(nodes), dtype=node_dtype)
+    for i, node in enumerate(nodes):
+        flat_nodes[i] = node
+    return flat_nodes
+
+
+def _flatten_node(tree, depth, nodes):
+    i = len(nodes)
+    if tree.lesser_child is None:
+        nodes.append((-1, tree.median, -1, -1, tree.id, tree.center))
+        return i
+
+    nodes.append(None)
+    lesser = _flatten_node(tree.lesser_child, depth + 1, nodes)
+    greater = _flatten_node(tree.greater_child, depth + 1, nodes)
+    nodes[i] = (depth % 2, tree.median, lesser, greater, -1, (np.nan, np.nan))
+    return i
+
+
+def save_flat_tree(flat_nodes, filename):
+    with open(filename, "wb") as output_file:
+        np.save(output_file, flat_nodes)
+
+
+# Write the flat tree as a nested json file, in the same layout as the json files of the tree construction.
+def save_json_tree(flat_nodes, filename):
+    with open(filename, "w") as output_file:
+        output_file.write(json.dumps(_unflatten_node(flat_nodes, 0), indent=4))
+
+
+def _unflatten_node(flat_nodes, i):
+    node = flat_nodes[i]
+    if node["lesser"] < 0:
+        return {"lesser_child": None, "greater_child": None, "median": 0, "center": node["center"].tolist(),
+                "id": int(node["leaf_id"])}
+    return {"lesser_child": _unflatten_node(flat_nodes, int(node["lesser"])),
+            "greater_child": _unflatten_node(flat_nodes, int(node["greater"])), "median": float(node["median"])}
+
+
+def load_flat_tree(filename):
+    return FlatTree(np.load(filename))
+
+
+# The name of the file with the summaries of the positions in the leaves of the given json tree file.
+def summaries_file(json_filename):
+    return os.path.splitext(json_filename)[0] + "_summaries.npz"
+
+
+# Read the number of positions in every leaf from the summaries of the given json tree file, or None if there are no
+# summaries that are at least as new as the json tree.
+def load_leaf_counts(json_filename):
+    summary_filename = summaries_file(json_filename)
+    if not os.path.isfile(summary_filename) or \
+            (os.path.isfile(json_filename) and os.path.getmtime(summary_filename) < os.path.getmtime(json_filename)):
+        return None
+    with np.load(summary_filename) as data:
+        return data["counts"]
+
+
+# Read the nested json tree, with a namedtuple for every node.
+def load_json_tree(filename):
+    with open(filename, 'r') as median_tree_file:
+        data = median_tree_file.read()
+    return json.loads(data, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+
+
+# Read the flat tree that belongs to the given json tree file if it exists, and the json tree otherwise. A flat tree that
+# is older than the json tree, e.g. when the json tree has been written again by an older version, is not used.
+def load_median_tree(json_filename):
+    flat_filename = flat_tree_file(json_filename)
+    if os.path.isfile(flat_filename):
+        if not os.path.isfile(json_filename) or os.path.getmtime(flat_filename) >= os.path.getmtime(json_filename):
+            return load_flat_tree(flat_filename)
+        print("The flat tree", flat_filename, "is older than", json_filename, "so the json tree is read instead.")
+    return load_json_tree(json_filename)
+
+
+# Convert an existing json tree file to a flat tree file.
+def convert_json_tree(json_filename, flat_filename=None):
+    if flat_filename is None:
+        flat_filename = flat_tree_file(json_filename)
+    save_flat_tree(flatten_tree(load_json_tree(json_filename)), flat_filename)
+
+
+# The tree is complete and its leaves are numbered from left to right, so the id of a leaf at depth k is the path to it,
+# with a bit for every level that is 0 for the lesser and 1 for the greater child. Dropping the last bits of the id of a
+# leaf thus gives the id of the subtree at a coarser level that holds it, so a trip clustered once with the deepest tree
+# can be assigned to the cluster at any coarser level. For a tree built on all positions, these subtrees are the leaves
+# of the tree of the smaller depth, but not for a tree built on a sample or refreshed with new months.
+def roll_up(cluster_id, depth, level):
+    return cluster_id >> (depth - level)
+
+
+# Get the given tree as a flat tree, flattening it when it is a nested tree.
+def as_flat_tree(tree):
+    return tree if isinstance(tree, FlatTree) else FlatTree(flatten_tree(tree))
+
+
+# A flat tree, of which the fields used for lookups are unpacked into lists and arrays.
+class FlatTree:
+    def __init__(self, flat_nodes):
+        self.nodes = flat_nodes
+        self.split_dimensions = flat_nodes["split_dimension"].tolist()
+        self.medians = flat_nodes["median"].tolist()
+        self.lesser = flat_nodes["lesser"].tolist()
+        self.greater = flat_nodes["greater"].tolist()
+        self.leaf_ids = flat_nodes["leaf_id"].tolist()
+
+        # The same fields as arrays, for the batch lookups. Leaves get split dimension 0, such that it is a valid index.
+        self.split_dimension_array = np.maximum(np.array(flat_nodes["split_dimension"], dtype=np.int64), 0)
+        self.median_array = np.array(flat_nodes["median"])
+        self.lesser_array = np.array(flat_nodes["lesser"], dtype=np.int64)
+        self.greater_array = np.array(flat_nodes["greater"], dtype=np.int64)
+        self.leaf_id_array = np.array(flat_nodes["leaf_id"], dtype=np.int64)
+
+        # The depth of the tree, which is complete, found by following the lesser children down to a leaf.
+        self.depth = 0
+        i = 0
+        while self.lesser[i] >= 0:
+            i = self.lesser[i]
+            self.depth += 1
+
+    # Get the id of the cluster of the given position, in the same way as walking down the nested tree does.
+    def get_cluster_id(self, pos):
+        i = 0
+        while self.lesser[i] >= 0:
+            if pos[self.split_dimensions[i]] < self.medians[i]:
+                i = self.lesser[i]
+            else:
+                i = self.greater[i]
+        return self.leaf_ids[i]
+
+    # Get the ids of the clusters of all the given positions at once, given as arrays of longitudes and latitudes.
+    # All positions walk down the tree together, one level per step, using the same rule as get_cluster_id.
+    def get_cluster_ids(self, lon, lat):
+        positions = np.stack((np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)))
+        nodes = np.zeros(positions.shape[1], dtype=np.int64)
+        active = np.flatnonzero(self.lesser_array[nodes] >= 0)
+
+        while len(active) > 0:
+            current = nodes[active]
+            values = positions[self.split_dimension_array[current], active]
+            nodes[active] = np.where(values < self.median_array[current], self.lesser_array[current],
+                                     self.greater_array[current])
+            active = active[self.lesser_array[nodes[active]] >= 0]
+        return self.leaf_id_array[nodes]
+
+    # Get the (id, center) of all leaves, in the order of their ids.
+    # When a coarser level is given, the leaves are rolled up into the clusters at that level. The center of such a
+    # cluster is the average of the centers of its leaves, weighted by the given number of positions in every leaf. As
+    # the center of a leaf is the average of its positions, this is the average of all positions in the cluster. Without
+    # counts, the leaves are weighted equally.
+    def get_leaves(self, level=None, counts=None):
+        is_leaf = self.nodes["lesser"] < 0
+        leaf_ids = self.nodes["leaf_id"][is_leaf]
+        order = np.argsort(leaf_ids, kind="stable")
+        leaf_ids = leaf_ids[order].astype(np.int64)
+        centers = self.nodes["center"][is_leaf][order]
+
+        if level is not None and level < self.depth:
+            weights = np.ones(len(leaf_ids)) if counts is None else np.asarray(counts, dtype=np.float64)[leaf_ids]
+
+            # The leaves of a cluster have consecutive ids. Clusters without any positions take the plain average.
+            leaf_ids, starts = np.unique(roll_up(leaf_ids, self.depth, level), return_index=True)
+            totals = np.add.reduceat(weights, starts)
+            sums = np.add.reduceat(centers * weights[:, None], starts, axis=0)
+            plain = np.add.reduceat(centers, starts, axis=0) / np.diff(np.append(starts, len(weights)))[:, None]
+            centers = np.where(totals[:, None] > 0, sums / np.maximum(totals, 1)[:, None], plain)
+        return list(zip(leaf_ids.tolist(), centers.tolist()))
+
+
+# Convert the json tree files given on the command line, e.g. "python flat_tree.py median_cluster_tree_k_10.json".
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        print("Converting", filename, "into", flat_tree_file(filename))
+        convert_json_tree(filename)
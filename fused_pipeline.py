@@ -0,0 +1,297 @@
+import io
+import os
+from collections import deque
+
+import numpy as np
+
+import median_clustering
+import pre_processing
+import sort_on_time
+from chunked_csv import fields_to_times, join_bytes, write_rows
+from compressed_io import intermediate_file, open_input, open_output
+from time_codec import parse_time
+from worker_pool import process_in_parallel
+
+# Running pre_processing, median_clustering and sort_on_time one after the other means that every month is read from
+# the network share, parsed and written back three times. The fused pipeline reads the raw trip (and fare) files once,
+# and hands each month from one step to the next in memory, after which only the sorted files are written.
+# Each step is done by the same functions as in the separate scripts, so the sorted files are exactly the same.
+# The months are processed in parallel by the workers of worker_pool.
+
+# The engine used to hand a month from one step to the next.
+#   - "columns" hands the chunks of rows that pre_processing selected over as they are, with the positions and start
+#     times it has parsed, to a ClusteredRows. The clusters and districts are found from the parsed positions, and every
+#     row is formatted only once, in the layout of the sorted files, which is then sorted on the parsed start times. It
+#     needs the chunked engines of pre_processing and median_clustering and the arrays engine of sort_on_time, and the
+#     text engine is used with any of the other engines.
+#   - "text" passes a month on through a TextPipe, which holds the text as the pieces that one step wrote and releases
+#     them as soon as the next step has read them, and which the next step parses again.
+# In both cases, a month is held about once at any time, which sort_on_time needs anyway.
+fused_engine = "columns"
+
+# Whether to also write the pre-processed and clustered files, to the same locations as the separate scripts do.
+# This is only needed to inspect the intermediate results, e.g. for debugging. The columns engine then keeps their text
+# in memory as well, until the month is written.
+materialize_intermediate_files = False
+
+
+# Whether the months are handed over as columns, which the chosen engines of the steps have to support.
+def uses_columns():
+    return fused_engine == "columns" and pre_processing.pre_processing_engine == "chunked" \
+        and median_clustering.clustering_engine == "chunked" and sort_on_time.sort_engine == "arrays"
+
+
+# Run all steps on a single month of taxi data, and return the number of accepted, rejected and duplicate rows.
+def process_taxi_month(month_id):
+    print("Processing", pre_processing.taxi_trip_files[month_id], "and", pre_processing.taxi_fare_files[month_id],
+          "into", intermediate_file(sort_on_time.taxi_output_files[month_id]))
+
+    # The taxi rows have two columns before the single column of the positions.
+    pre_processed = ClusteredRows(2, 1) if uses_columns() else TextPipe()
+    counts = (0, 0, 0)
+    if month_id not in pre_processing.excluded_taxi_months:
+        with open_input(pre_processing.taxi_trip_files[month_id]) as data_file, \
+                open_input(pre_processing.taxi_fare_files[month_id]) as fare_file:
+            # Skip the headers of both files.
+            next(data_file, None)
+            next(fare_file, None)
+            counts = pre_processing.pre_process_taxi_rows(data_file, fare_file, pre_processed)
+
+    sort_rows(pre_processed, 11, pre_processing.taxi_header, pre_processing.taxi_output_files[month_id],
+              median_clustering.taxi_header, median_clustering.taxi_output_files[month_id],
+              sort_on_time.taxi_output_files[month_id])
+    return counts
+
+
+# Run all steps on a single month of bike data, and return the number of accepted and rejected rows.
+def process_bike_month(month_id):
+    print("Processing", pre_processing.bike_trip_files[month_id], "into",
+          intermediate_file(sort_on_time.bike_output_files[month_id]))
+
+    # The bike rows have three columns before the four columns of the positions.
+    pre_processed = ClusteredRows(3, 4) if uses_columns() else TextPipe()
+    with open_input(pre_processing.bike_trip_files[month_id]) as data_file:
+        # Skip the header.
+        next(data_file, None)
+        counts = pre_processing.pre_process_bike_rows(data_file, pre_processed)
+
+    sort_rows(pre_processed, 8, pre_processing.bike_header, pre_processing.bike_output_files[month_id],
+              median_clustering.bike_header, median_clustering.bike_output_files[month_id],
+              sort_on_time.bike_output_files[month_id])
+    return counts
+
+
+# Set the clusters of the pre-processed rows, which have the given number of fields, and write them sorted on time.
+# The rows are given as a ClusteredRows, or as a TextPipe, in which every row is preceded by a newline, which is what the
+# steps write after the header. Reading such text as lines gives an empty first line, which takes the place of the
+# header of a file.
+def sort_rows(pre_processed, nr_fields, pre_processed_header, pre_processed_file, clustered_header, clustered_file,
+              output_file_name):
+    if isinstance(pre_processed, ClusteredRows):
+        materialize(pre_processed_file, pre_processed_header, pre_processed.pre_processed)
+        materialize(clustered_file, clustered_header, pre_processed.clustered)
+        with open_output(intermediate_file(output_file_name)) as output_file:
+            output_file.write(clustered_header)
+            pre_processed.write_sorted(output_file, output_file_name)
+        return
+
+    materialize(pre_processed_file, pre_processed_header, pre_processed)
+    clustered = TextPipe()
+    next(pre_processed, None)
+    median_clustering.process_rows(pre_processed, nr_fields, clustered, output_file_name)
+
+    materialize(clustered_file, clustered_header, clustered)
+    next(clustered, None)
+    with open_output(intermediate_file(output_file_name)) as output_file:
+        output_file.write(clustered_header)
+        sort_on_time.sort_lines(clustered, output_file)
+
+
+# Write the rows of an intermediate step, which have not been read yet, to its file if the intermediate files are
+# materialized.
+def materialize(filename, header, rows):
+    if materialize_intermediate_files:
+        with open_output(intermediate_file(filename)) as output_file:
+            output_file.write(header)
+            for piece in rows.pieces:
+                output_file.write(piece)
+
+
+# The rows of a month, which pre_processing hands over as RowChunks. The clusters and districts of the rows are found
+# from their parsed positions, after which the rows are formatted in the layout of the clustered and sorted files, and
+# kept as utf-8 encoded text next to their start times and line numbers. Once all chunks are in, the rows are written
+# sorted on their start times, where rows with the same start time keep the order of their lines.
+# The columns of a chunk consist of the given number of columns before the positions, the given number of columns of
+# the positions, and the columns after the positions.
+class ClusteredRows:
+    def __init__(self, nr_head_columns, nr_position_columns):
+        self.nr_head_columns = nr_head_columns
+        self.nr_position_columns = nr_position_columns
+        median_clustering.clear_caches()
+        self.labels = median_clustering.ChunkLabels()
+
+        # The rows as encoded text, with the end of every row and its start time and line number, in pieces.
+        self.buffers = [np.zeros(0, dtype=np.uint8)]
+        self.line_ends = [np.zeros(0, dtype=np.int64)]
+        self.start_times = [np.zeros(0, dtype=np.int64)]
+        self.line_numbers = [np.zeros(0, dtype=np.int64)]
+        self.nr_bytes = 0
+        self.nr_lines = 0
+
+        # The pre-processed and clustered text, which is only kept when the intermediate files are materialized.
+        self.pre_processed = TextPipe()
+        self.clustered = TextPipe()
+
+    # Set the clusters and districts of a chunk of rows, and keep them. Returns the number of rows.
+    def write_chunk(self, chunk):
+        if materialize_intermediate_files:
+            chunk.write_to(self.pre_processed)
+
+        # The output consists of the fields before the positions, the two clusters, all fields after the positions and
+        # the two districts.
+        from_clusters, to_clusters, from_districts, to_districts = self.labels.find_columns(chunk.positions)
+        output, output_ends = join_bytes(chunk.columns[:self.nr_head_columns] + [from_clusters, to_clusters] +
+                                         chunk.columns[self.nr_head_columns + self.nr_position_columns:] +
+                                         [from_districts, to_districts])
+
+        # The accepted faulty lines go through the line loop of median_clustering as well.
+        faulty_rows = sorted(chunk.faulty_texts)
+        faulty_texts = {}
+        for i in faulty_rows:
+            text_file = io.StringIO()
+            median_clustering.process_lines([chunk.faulty_texts[i][1:]], text_file)
+            faulty_texts[i] = text_file.getvalue()
+        if materialize_intermediate_files:
+            write_rows(output.tobytes().decode("utf-8"), output_ends, chunk.keep, chunk.faulty,
+                       lambda i: pre_processing.write_faulty_text(faulty_texts, i, self.clustered), self.clustered)
+
+        start_times = chunk.start_times
+        if start_times is None:
+            # The bike rows are not selected on their start times, which is the second column of their chunks.
+            start_times = parse_start_times(*chunk.columns[1])
+        self.add_rows(output, output_ends, start_times, np.flatnonzero(chunk.keep))
+
+        faulty_output = "".join(faulty_texts[i] for i in faulty_rows).encode("utf-8")
+        self.add_rows(np.frombuffer(faulty_output, dtype=np.uint8),
+                      np.cumsum([len(faulty_texts[i].encode("utf-8")) for i in faulty_rows], dtype=np.int64),
+                      np.array([parse_time(faulty_texts[i].split(",", 2)[1]) for i in faulty_rows], dtype=np.int64),
+                      np.array(faulty_rows, dtype=np.int64))
+
+        self.nr_lines += len(chunk.keep)
+        return len(output_ends) + len(faulty_rows)
+
+    # Keep the given encoded rows, with the end of every row, their start times and their line numbers in the chunk.
+    def add_rows(self, buffer, line_ends, start_times, line_numbers):
+        self.buffers.append(buffer)
+        self.line_ends.append(line_ends + self.nr_bytes)
+        self.start_times.append(start_times)
+        self.line_numbers.append(line_numbers + self.nr_lines)
+        self.nr_bytes += len(buffer)
+
+    # Write all rows sorted on their start times, each preceded by a newline.
+    def write_sorted(self, output_file, name):
+        buffer = np.concatenate(self.buffers)
+        self.buffers = []
+        line_ends = np.concatenate(self.line_ends)
+
+        # Every row is preceded by a newline, so it starts right after the end of the row before it.
+        line_starts = np.concatenate(([0], line_ends[:-1])).astype(np.int64) + 1
+        order = np.lexsort((np.concatenate(self.line_numbers), np.concatenate(self.start_times)))
+        sort_on_time.write_ordered_lines(buffer, line_starts, line_ends, order, output_file)
+        median_clustering.report_caches(name)
+
+
+# Convert the start times of the given column, converting the times that are not in the fixed format one by one.
+def parse_start_times(buffer, starts, ends):
+    start_times, is_irregular = fields_to_times(buffer, starts, ends)
+    for i in np.flatnonzero(is_irregular).tolist():
+        start_times[i] = parse_time(buffer[starts[i]:ends[i]].tobytes().decode("utf-8"))
+    return start_times
+
+
+# Text that is written by one step and read by the next, as a file that is written in full before it is read.
+# The text is held as the pieces that were written, which are released once they have been read. It can be read as
+# lines, in the same way as the lines of an io.StringIO, or in blocks with read.
+class TextPipe:
+    def __init__(self):
+        self.pieces = deque()
+
+        # The lines of the pieces that have been split but not read yet, in reverse order, and the start of the line
+        # that continues in the next piece.
+        self.lines = []
+        self.rest = ""
+
+    def write(self, text):
+        if len(text) > 0:
+            self.pieces.append(text)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self.lines) == 0:
+            if len(self.pieces) == 0:
+                if len(self.rest) == 0:
+                    raise StopIteration
+                line, self.rest = self.rest, ""
+                return line
+
+            lines = (self.rest + self.pieces.popleft()).split("\n")
+            self.rest = lines.pop()
+            self.lines = [line + "\n" for line in reversed(lines)]
+        return self.lines.pop()
+
+    def read(self, size=-1):
+        # Put the text of the lines that have been split but not read back in front of the pieces.
+        if len(self.lines) > 0 or len(self.rest) > 0:
+            self.pieces.appendleft("".join(reversed(self.lines)) + self.rest)
+            self.lines = []
+            self.rest = ""
+
+        if size < 0:
+            size = sum(len(piece) for piece in self.pieces)
+        parts = []
+        length = 0
+        while len(self.pieces) > 0 and length < size:
+            piece = self.pieces.popleft()
+            if length + len(piece) > size:
+                self.pieces.appendleft(piece[size - length:])
+                piece = piece[:size - length]
+            parts.append(piece)
+            length += len(piece)
+        return "".join(parts)
+
+
+def process_taxi_files():
+    counts = process_in_parallel(process_taxi_month, range(0, len(sort_on_time.taxi_output_files)))
+    pre_processing.report_counts(sort_on_time.taxi_output_files, counts)
+
+
+def process_bike_files():
+    counts = process_in_parallel(process_bike_month, range(0, len(sort_on_time.bike_output_files)))
+    pre_processing.report_counts(sort_on_time.bike_output_files, counts)
+
+
+def process_files():
+    if any(os.path.isfile(intermediate_file(filename)) for filename in sort_on_time.taxi_output_files):
+        answer = ""
+        while answer not in ["y", "n"]:
+            answer = input("Sorted taxi files already exist. Are you sure you want to continue [Y/N]? ").lower()
+        if answer == "y":
+            process_taxi_files()
+    else:
+        process_taxi_files()
+
+    if any(os.path.isfile(intermediate_file(filename)) for filename in sort_on_time.bike_output_files):
+        answer = ""
+        while answer not in ["y", "n"]:
+            answer = input("Sorted bike files already exist. Are you sure you want to continue [Y/N]? ").lower()
+        if answer == "y":
+            process_bike_files()
+    else:
+        process_bike_files()
+
+
+# The worker processes import this module, so only start processing when the module is run as a script.
+if __name__ == "__main__":
+    process_files()
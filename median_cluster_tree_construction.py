@@ -1,6 +1,18 @@
 # The partitioning into clusters is represented as a tree.
 import json
+import math
+import multiprocessing
 import os
+import sys
+from itertools import islice
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from chunked_csv import fields_to_floats, split_lines
+from compressed_io import intermediate_file, open_input
+from flat_tree import FlatTree, as_flat_tree, flat_tree_file, flatten_tree, load_median_tree, save_flat_tree, \
+    save_json_tree, summaries_file
 
 # The folder and files we plan to take data from.
 taxi_folder_folder = "Z:\\data_engineering\\taxi_pre_processed_trip_data"
@@ -14,8 +26,49 @@ median_cluster_tree_folder = "Z:\\data_engineering"
 median_cluster_tree_file = "median_cluster_tree_k_" + str(k) + ".json"
 
 # Unique id counter for each node.
+# The leaves are numbered from left to right, such that the id of a leaf is its path from the root (see flat_tree.roll_up).
 id_counter = 0
 
+# The engine used to build the tree.
+#   - "arrays" keeps all positions in two float64 arrays, and splits every subtree in place around its median.
+#   - "lists" keeps a list of position tuples in every leaf, which is fully sorted at every level.
+#   - "sample" streams the files and takes the medians from a fixed size reservoir sample of the positions, after which
+#     the centers are calculated from all positions in a second pass. Its memory does not grow with the number of trips,
+#     but the medians are approximate.
+# The arrays and lists engines result in exactly the same tree.
+tree_construction_engine = "arrays"
+
+# The number of lines that are read at once when reading the positions into arrays.
+chunk_size = 100000
+
+# The bound on the error in the rank of the medians found by the sample engine, as a fraction of the size of the node,
+# which holds with the given confidence for the nodes at the deepest level. The size of the reservoir sample follows
+# from this bound (by the Dvoretzky-Kiefer-Wolfowitz inequality), unless it is set explicitly. As the size from the
+# bound doubles with every level, it is limited to the maximum sample size, which keeps the memory of deep trees fixed.
+sample_rank_error = 0.01
+sample_confidence = 0.99
+sample_size = None
+maximum_sample_size = 4000000
+
+# The seed of the random sampling, such that a tree can be built again.
+sample_seed = 0
+
+# The number of worker processes that build the subtrees of the arrays engine at the same time.
+# The first levels are split in this process, until there is a subtree for every worker. The positions are placed in
+# shared memory, such that the workers do not need a copy of them. With a single worker, the tree is built in this
+# process as a whole.
+number_of_workers = os.cpu_count()
+
+# Whether to keep summaries of the positions in each leaf next to the tree, with which the tree can be refreshed when new
+# months arrive, instead of building it again from scratch. Creating them takes another pass over the files.
+keep_leaf_summaries = True
+
+# The maximum number of positions sampled for each leaf of the summaries.
+leaf_sample_size = 256
+
+# A subtree is split again when the number of positions of its two halves differ by more than this fraction of the total.
+refresh_tolerance = 0.05
+
 
 class Node:
     # Initialize the node to have no children and zero valued fields.
@@ -58,9 +111,10 @@ class Node:
             self.id = id_counter
             id_counter += 1
 
-            # Find the center point.
-            n = len(self.entries)
-            self.center = (sum(i[0] for i in self.entries) / n, sum(i[1] for i in self.entries) / n)
+            # Find the center point, unless it has been calculated while building the tree.
+            if self.entries is not None:
+                n = len(self.entries)
+                self.center = (sum(i[0] for i in self.entries) / n, sum(i[1] for i in self.entries) / n)
 
         # Delete any mention of entries.
         del self.entries
@@ -82,14 +136,24 @@ class Node:
         with open(median_cluster_tree_folder + "\\" + median_cluster_tree_file, "w") as output_file:
             output_file.write(self.to_json())
 
+        # Also store the tree as a flat array, which is much faster to load.
+        save_flat_tree(flatten_tree(self), flat_tree_file(median_cluster_tree_folder + "\\" + median_cluster_tree_file))
+
 
 def build_tree(depth):
+    if tree_construction_engine == "arrays":
+        lon, lat = read_positions(taxi_output_files)
+        print("The tree is based on", len(lon), "start position entries.")
+        return build_tree_from_arrays((lon, lat), depth)
+    elif tree_construction_engine == "sample":
+        return build_tree_from_sample(taxi_output_files, depth)
+
     # The root of our tree.
     tree_root = Node()
 
     for filename in taxi_output_files:
-        print("Processing file", filename)
-        process_file(filename, tree_root)
+        print("Processing file", intermediate_file(filename))
+        process_file(intermediate_file(filename), tree_root)
 
     print("The tree is based on", len(tree_root.entries), "start position entries.")
 
@@ -102,7 +166,7 @@ def build_tree(depth):
 
 
 def process_file(filename, tree_root):
-    with open(filename, "r") as input_file:
+    with open_input(filename) as input_file:
         is_first = True
 
         for line in input_file:
@@ -117,15 +181,453 @@ def process_file(filename, tree_root):
             tree_root.register_entry((float(data_fields[3]), float(data_fields[4])))
 
 
-if os.path.isfile(median_cluster_tree_folder + "\\" + median_cluster_tree_file):
-    answer = ""
-    while answer not in ["y", "n"]:
-        answer = input("The median cluster tree file already exist. Are you sure you want to continue [Y/N]? ").lower()
-    if answer == "y":
+def process_files():
+    if os.path.isfile(median_cluster_tree_folder + "\\" + median_cluster_tree_file):
+        answer = ""
+        while answer not in ["y", "n"]:
+            answer = input("The median cluster tree file already exist. Are you sure you want to continue [Y/N]? ").lower()
+        if answer == "y":
+            tree = build_tree(k)
+            tree.write_to_file()
+            if keep_leaf_summaries:
+                summarize_leaves(FlatTree(flatten_tree(tree)), taxi_output_files).save(leaf_summary_file())
+    else:
         tree = build_tree(k)
         tree.write_to_file()
-else:
-    tree = build_tree(k)
-    tree.write_to_file()
+        if keep_leaf_summaries:
+            summarize_leaves(FlatTree(flatten_tree(tree)), taxi_output_files).save(leaf_summary_file())
+
+
+# Read the start positions of all the given files into a longitude and a latitude array.
+def read_positions(filenames):
+    positions = list(iterate_positions(filenames))
+    positions = np.concatenate(positions) if len(positions) > 0 else np.zeros((0, 2))
+    return np.ascontiguousarray(positions[:, 0]), np.ascontiguousarray(positions[:, 1])
+
+
+# Iterate over the start positions of all the given files, as (lines x 2) arrays of at most chunk_size positions.
+def iterate_positions(filenames):
+    for filename in filenames:
+        print("Processing file", intermediate_file(filename))
+        with open_input(intermediate_file(filename)) as input_file:
+            # Skip the header.
+            next(input_file, None)
+
+            while True:
+                lines = list(islice(input_file, chunk_size))
+                if len(lines) == 0:
+                    break
+                yield read_chunk_positions(lines)
+
+
+# Convert the start positions of a chunk of lines to a (lines x 2) array.
+def read_chunk_positions(lines):
+    buffer, starts, ends, faulty = split_lines(lines, 11)
+    values, faulty_values = fields_to_floats(buffer, starts[:, 3:5].reshape(-1), ends[:, 3:5].reshape(-1))
+    values = values.reshape(-1, 2)
+
+    # The lines that cannot be handled as a whole are converted one by one, like process_file does.
+    for i in np.flatnonzero(faulty | faulty_values.reshape(-1, 2).any(axis=1)).tolist():
+        data_fields = lines[i].strip().split(",")
+        values[i] = (float(data_fields[3]), float(data_fields[4]))
+    return values
+
+
+# Build a tree of the given depth, on the positions given as a pair of longitude and latitude arrays.
+#
+# The lists engine sorts the entries of a leaf with a stable sort, such that entries with an equal coordinate stay in
+# the order of the parent. As such, the order of the entries of a node at depth d > 1 is given by the coordinate of the
+# split at depth d - 1, then the other coordinate and finally the order in which the entries were read. At depth 1 it is
+# the longitude followed by the read order, and at the root it is simply the read order.
+# This order determines which of the entries equal to the median end up in the lesser child, and the order in which the
+# coordinates of a leaf are summed, so we use it to break ties and to calculate the centers.
+def build_tree_from_arrays(positions, depth):
+    indices = np.arange(len(positions[0]), dtype=np.int64)
+    parallel_depth = min(math.ceil(math.log2(number_of_workers)), depth) if number_of_workers > 1 else 0
+    if parallel_depth == 0:
+        return split_node(positions, indices, 0, depth)
+
+    # Place the positions and the indices in shared memory.
+    arrays = positions + (indices,)
+    blocks = [shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) for array in arrays]
+    try:
+        shared = [np.ndarray(array.shape, array.dtype, buffer=block.buf) for array, block in zip(arrays, blocks)]
+        for shared_array, array in zip(shared, arrays):
+            shared_array[:] = array
+
+        # Split the first levels here, and hand the subtrees below them to the workers.
+        subtrees = []
+        tree_root = split_top_levels((shared[0], shared[1]), shared[2], 0, parallel_depth, subtrees)
+        tasks = [([block.name for block in blocks], len(indices), start, end, parallel_depth, depth - parallel_depth)
+                 for _, start, end in subtrees]
+        with multiprocessing.Pool(number_of_workers) as pool:
+            results = pool.map(build_subtree, tasks, chunksize=1)
+
+        # Hang the subtrees in the tree, in the place of the nodes they were built for.
+        for (node, _, _), subtree in zip(subtrees, results):
+            node.__dict__.update(subtree.__dict__)
+        del shared
+        return tree_root
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+# Split the first levels of the tree, and collect the (node, start, end) of the entries of each node at the last level.
+def split_top_levels(positions, indices, depth, remaining_depth, subtrees, start=0):
+    node = Node()
+    node.entries = None
+    if remaining_depth == 0:
+        subtrees.append((node, start, start + len(indices)))
+        return node
+
+    node.median, i = split_entries(positions, indices, depth)
+    node.lesser_child = split_top_levels(positions, indices[:i], depth + 1, remaining_depth - 1, subtrees, start)
+    node.greater_child = split_top_levels(positions, indices[i:], depth + 1, remaining_depth - 1, subtrees, start + i)
+    return node
+
+
+# Build the subtree of the given entries in a worker process, on the positions and indices in shared memory.
+def build_subtree(task):
+    names, nr_positions, start, end, depth, remaining_depth = task
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    try:
+        positions = tuple(np.ndarray((nr_positions,), np.float64, buffer=block.buf) for block in blocks[:2])
+        indices = np.ndarray((nr_positions,), np.int64, buffer=blocks[2].buf)
+        subtree = split_node(positions, indices[start:end], depth, remaining_depth)
+
+        # Release the views on the shared memory, before it is closed.
+        del positions, indices
+        return subtree
+    finally:
+        for block in blocks:
+            block.close()
+
+
+# Split the node with the given entries at the given depth, and all the levels below it.
+# The entries are given as the indices of their positions, which are rearranged in place.
+def split_node(positions, indices, depth, remaining_depth):
+    node = Node()
+    node.entries = None
+
+    if remaining_depth == 0:
+        # Sum the coordinates in the same order as the lists engine does.
+        indices[:] = indices[np.lexsort(order_keys(positions, indices, depth))]
+        n = len(indices)
+        node.center = (sum(positions[0][indices].tolist()) / n, sum(positions[1][indices].tolist()) / n)
+        return node
+
+    node.median, i = split_entries(positions, indices, depth)
+    node.lesser_child = split_node(positions, indices[:i], depth + 1, remaining_depth - 1)
+    node.greater_child = split_node(positions, indices[i:], depth + 1, remaining_depth - 1)
+    return node
+
+
+# Find the median of the given entries at the given depth, and rearrange the entries in place such that the first half
+# of them belongs to the lesser child. Returns the median and the number of entries in the lesser child.
+def split_entries(positions, indices, depth):
+    # Find the median in linear time.
+    values = positions[depth % 2][indices]
+    i = len(indices) // 2
+    median = np.partition(values, i)[i]
+    is_lesser = values < median
+
+    # Of the entries equal to the median, the ones that come first in the order of the node go to the lesser child.
+    # Equal values can only differ in their sign if they are zero, in which case we take the exact entry at the median.
+    equal = np.flatnonzero(values == median)
+    nr_lesser_equal = i - np.count_nonzero(is_lesser)
+    if nr_lesser_equal > 0 or median == 0:
+        order = np.lexsort(order_keys(positions, indices[equal], depth))
+        is_lesser[equal[order[:nr_lesser_equal]]] = True
+        median = values[equal[order[nr_lesser_equal]]]
+
+    indices[:] = np.concatenate((indices[is_lesser], indices[~is_lesser]))
+    return float(median), i
+
+
+# The keys that give the order of the entries of a node at the given depth, in the reversed form that np.lexsort expects.
+def order_keys(positions, indices, depth):
+    if depth == 0:
+        return indices,
+    if depth == 1:
+        return indices, positions[0][indices]
+    return indices, positions[depth % 2][indices], positions[(depth - 1) % 2][indices]
+
+
+# Build a tree of the given depth, of which the medians are taken from a reservoir sample of the positions in the files.
+# The centers of the leaves are the averages of all positions that end up in them, using the same lookup as the
+# clustering step.
+def build_tree_from_sample(filenames, depth):
+    size = sample_size
+    if size is None:
+        # Every node at the deepest level of splits holds about 1 / 2^(depth - 1) of the sample.
+        size = math.ceil(2 ** max(depth - 1, 0) * math.log(2 / (1 - sample_confidence)) / (2 * sample_rank_error ** 2))
+        size = min(size, maximum_sample_size)
+
+    # Keep a uniform sample of the given size of all positions seen so far (Algorithm R). The sample grows with the
+    # positions until it is full, such that small inputs do not allocate the full size.
+    generator = np.random.default_rng(sample_seed)
+    sample = np.zeros((0, 2))
+    nr_positions = 0
+    for positions in iterate_positions(filenames):
+        ranks = np.arange(nr_positions, nr_positions + len(positions))
+        nr_filled = max(min(size - nr_positions, len(positions)), 0)
+        if nr_positions + nr_filled > len(sample):
+            grown = np.zeros((min(max(2 * len(sample), nr_positions + nr_filled), size), 2))
+            grown[:nr_positions] = sample[:nr_positions]
+            sample = grown
+        sample[nr_positions:nr_positions + nr_filled] = positions[:nr_filled]
+
+        # Every later position replaces a random entry of the sample, with a probability of size / (rank + 1). When a
+        # chunk replaces the same entry more than once, the last of its positions is the one that stays.
+        slots = generator.integers(0, ranks[nr_filled:] + 1)
+        is_kept = np.flatnonzero(slots < size)
+        slots, last = np.unique(slots[is_kept][::-1], return_index=True)
+        sample[slots] = positions[nr_filled:][is_kept[::-1][last]]
+        nr_positions += len(positions)
+
+    sample = sample[:min(size, nr_positions)]
+    print("The tree is based on a sample of", len(sample), "out of", nr_positions, "start position entries.")
+    tree_root = build_tree_from_arrays((np.ascontiguousarray(sample[:, 0]), np.ascontiguousarray(sample[:, 1])), depth)
+
+    # Find the leaf of every position in a second pass, and sum the positions of each leaf.
+    leaves = []
+    collect_leaves(tree_root, leaves)
+    counts = np.zeros(len(leaves), dtype=np.int64)
+    sums = np.zeros((len(leaves), 2))
+    for positions in iterate_positions(filenames):
+        leaf_ids = find_leaves(tree_root, positions, depth)
+        counts += np.bincount(leaf_ids, minlength=len(leaves))
+        sums[:, 0] += np.bincount(leaf_ids, weights=positions[:, 0], minlength=len(leaves))
+        sums[:, 1] += np.bincount(leaf_ids, weights=positions[:, 1], minlength=len(leaves))
+
+    # Leaves without any positions keep the center of their sample.
+    for leaf, count, total in zip(leaves, counts.tolist(), sums.tolist()):
+        if count > 0:
+            leaf.center = (total[0] / count, total[1] / count)
+
+    report_populations(counts, nr_positions)
+    return tree_root
+
+
+# Collect the leaves of the tree, in the order in which finalize assigns the ids.
+def collect_leaves(tree, leaves):
+    if tree.lesser_child is None:
+        leaves.append(tree)
+    else:
+        collect_leaves(tree.lesser_child, leaves)
+        collect_leaves(tree.greater_child, leaves)
 
 
+# Find the leaf of each of the positions, in the same way as get_cluster_id does, numbered in the order of the ids.
+# This relies on the tree being complete, as it is when it is built on a sample that has at least 2^depth entries.
+def find_leaves(tree, positions, depth):
+    # Lay out the medians level by level, with the children of node i at 2i + 1 and 2i + 2.
+    medians = np.zeros(2 ** depth)
+    level = [tree]
+    for i in range(0, depth):
+        medians[2 ** i - 1:2 ** (i + 1) - 1] = [node.median for node in level]
+        level = [child for node in level for child in (node.lesser_child, node.greater_child)]
+
+    nodes = np.zeros(len(positions), dtype=np.int64)
+    for i in range(0, depth):
+        nodes = 2 * nodes + np.where(positions[:, i % 2] < medians[nodes], 1, 2)
+    return nodes - (2 ** depth - 1)
+
+
+# Report how far the population of each leaf is from the ideal population of an exact median tree.
+def report_populations(counts, nr_positions):
+    ideal = nr_positions / len(counts)
+    deviations = (counts - ideal) / ideal * 100 if ideal > 0 else np.zeros(len(counts))
+    for leaf_id, (count, deviation) in enumerate(zip(counts.tolist(), deviations.tolist())):
+        print("Leaf", leaf_id, "has", count, "entries, which is %+.2f%% from the ideal %.1f" % (deviation, ideal))
+    print("The leaf populations are at most %.2f%% and on average %.2f%% from the ideal %.1f"
+          % (np.abs(deviations).max(initial=0), np.abs(deviations).mean() if len(counts) > 0 else 0, ideal))
+
+
+# The name of the file with the leaf summaries of the tree.
+def leaf_summary_file():
+    return summaries_file(median_cluster_tree_folder + "\\" + median_cluster_tree_file)
+
+
+# Compact summaries of the positions in each leaf of the tree, which are used to refresh the tree when new months arrive.
+# For every leaf we keep the number of positions, the sums of their coordinates and a sample of at most leaf_sample_size
+# of them. Every position gets a random key, and the sample of a leaf holds its positions with the smallest keys. As all
+# leaves share the same keys, the sampled positions of a subtree up to the smallest largest key of its partial samples
+# are a uniform sample of all positions in the subtree, which is what the subtree is split again on.
+class LeafSummaries:
+    def __init__(self, nr_leaves):
+        self.counts = np.zeros(nr_leaves, dtype=np.int64)
+        self.sums = np.zeros((nr_leaves, 2))
+        self.sample_leaves = np.zeros(0, dtype=np.int64)
+        self.sample_positions = np.zeros((0, 2))
+        self.sample_keys = np.zeros(0)
+
+        # The leaves that received positions since the summaries were loaded.
+        self.has_new_positions = np.zeros(nr_leaves, dtype=bool)
+
+    # Add the given positions, with their leaf ids and random keys.
+    def add(self, leaf_ids, positions, keys):
+        self.counts += np.bincount(leaf_ids, minlength=len(self.counts))
+        self.sums[:, 0] += np.bincount(leaf_ids, weights=positions[:, 0], minlength=len(self.counts))
+        self.sums[:, 1] += np.bincount(leaf_ids, weights=positions[:, 1], minlength=len(self.counts))
+        self.has_new_positions[leaf_ids] = True
+        self.set_sample(np.concatenate((self.sample_leaves, leaf_ids)),
+                        np.concatenate((self.sample_positions, positions)), np.concatenate((self.sample_keys, keys)))
+
+    # Keep the positions with the smallest keys of each leaf as its sample.
+    def set_sample(self, leaves, positions, keys):
+        order = np.lexsort((keys, leaves))
+        leaves, positions, keys = leaves[order], positions[order], keys[order]
+        is_kept = np.arange(len(leaves)) - np.searchsorted(leaves, leaves) < leaf_sample_size
+        self.sample_leaves, self.sample_positions, self.sample_keys = leaves[is_kept], positions[is_kept], keys[is_kept]
+
+    # Get a uniform sample of the positions in the leaves with ids from first up to end, and their keys.
+    def subtree_sample(self, first, end):
+        in_subtree = (self.sample_leaves >= first) & (self.sample_leaves < end)
+        leaves, keys = self.sample_leaves[in_subtree] - first, self.sample_keys[in_subtree]
+
+        # A leaf of which not all positions are sampled only has its positions up to the largest key in its sample.
+        is_partial = np.bincount(leaves, minlength=end - first) < self.counts[first:end]
+        threshold = np.inf
+        if is_partial.any():
+            largest_keys = np.zeros(end - first)
+            np.maximum.at(largest_keys, leaves, keys)
+            threshold = largest_keys[is_partial].min()
+
+        is_selected = keys <= threshold
+        return self.sample_positions[in_subtree][is_selected], keys[is_selected]
+
+    # Replace the summaries of the leaves with ids from first up to end by those of a new subtree, based on its sample.
+    # The positions of the subtree are divided over the new leaves in the same proportions as the sample.
+    def replace(self, first, end, leaf_ids, positions, keys):
+        sizes = np.bincount(leaf_ids - first, minlength=end - first)
+        counts = np.round(self.counts[first:end].sum() * sizes / len(leaf_ids)).astype(np.int64)
+        for dimension in [0, 1]:
+            means = np.bincount(leaf_ids - first, weights=positions[:, dimension], minlength=end - first) / sizes
+            self.sums[first:end, dimension] = means * counts
+        self.counts[first:end] = counts
+
+        is_outside = (self.sample_leaves < first) | (self.sample_leaves >= end)
+        self.set_sample(np.concatenate((self.sample_leaves[is_outside], leaf_ids)),
+                        np.concatenate((self.sample_positions[is_outside], positions)),
+                        np.concatenate((self.sample_keys[is_outside], keys)))
+
+    def save(self, filename):
+        with open(filename, "wb") as output_file:
+            np.savez(output_file, counts=self.counts, sums=self.sums, sample_leaves=self.sample_leaves,
+                     sample_positions=self.sample_positions, sample_keys=self.sample_keys)
+
+
+def load_leaf_summaries(filename):
+    with np.load(filename) as data:
+        summaries = LeafSummaries(len(data["counts"]))
+        summaries.counts, summaries.sums = data["counts"], data["sums"]
+        summaries.sample_leaves, summaries.sample_positions = data["sample_leaves"], data["sample_positions"]
+        summaries.sample_keys = data["sample_keys"]
+    return summaries
+
+
+# Add the start positions of the given files to the summaries of the leaves of the given flat tree they end up in.
+def summarize_leaves(tree, filenames, summaries=None):
+    if summaries is None:
+        summaries = LeafSummaries(2 ** tree.depth)
+
+    # The keys depend on the number of positions seen before, such that every refresh draws different keys.
+    generator = np.random.default_rng([sample_seed, int(summaries.counts.sum())])
+    for positions in iterate_positions(filenames):
+        summaries.add(tree.get_cluster_ids(positions[:, 0], positions[:, 1]), positions,
+                      generator.random(len(positions)))
+    return summaries
+
+
+# Add the start positions of the given new files to the tree, and split the subtrees that are no longer balanced again.
+# All other leaves keep their positions and ids, so only the trips in the clusters of the subtrees that have been split
+# again need to be clustered again. Returns the (first, end) ids of the clusters of those subtrees.
+def refresh_tree(filenames):
+    tree_filename = median_cluster_tree_folder + "\\" + median_cluster_tree_file
+    tree = as_flat_tree(load_median_tree(tree_filename))
+    nodes = np.array(tree.nodes)
+
+    if os.path.isfile(leaf_summary_file()):
+        summaries = load_leaf_summaries(leaf_summary_file())
+    else:
+        print("There are no leaf summaries yet, so the files the tree is based on are summarized first.")
+        summaries = summarize_leaves(tree, [filename for filename in taxi_output_files if filename not in filenames])
+        summaries.has_new_positions[:] = False
+    summarize_leaves(tree, filenames, summaries)
+
+    # Split the subtrees that drifted past the tolerance again, on a sample of their positions.
+    subtrees = []
+    find_drifted_subtrees(tree, summaries.counts, 0, 0, 0, subtrees)
+    samples = []
+    for i, depth, first, end in subtrees:
+        positions, keys = summaries.subtree_sample(first, end)
+        if len(positions) < end - first:
+            print("Clusters", first, "to", end - 1, "have drifted, but have too few sampled positions to be split again.")
+            continue
+
+        subtree = split_node((np.ascontiguousarray(positions[:, 0]), np.ascontiguousarray(positions[:, 1])),
+                             np.arange(len(positions), dtype=np.int64), depth, tree.depth - depth)
+        global id_counter
+        id_counter = first
+        subtree.finalize()
+
+        # Hang the subtree in the flat tree, in the place of the old one.
+        flat_subtree = flatten_tree(subtree, depth)
+        for field in ["lesser", "greater"]:
+            flat_subtree[field][flat_subtree[field] >= 0] += i
+        nodes[i:i + len(flat_subtree)] = flat_subtree
+        samples.append((first, end, positions, keys))
+        print("Clusters", first, "to", end - 1, "have drifted, and have been split again.")
+
+    # Update the summaries of the subtrees that have been split again, and the centers of the other leaves.
+    tree = FlatTree(nodes)
+    is_updated = summaries.has_new_positions
+    for first, end, positions, keys in samples:
+        summaries.replace(first, end, tree.get_cluster_ids(positions[:, 0], positions[:, 1]), positions, keys)
+        is_updated[first:end] = False
+
+    leaves = np.flatnonzero(nodes["lesser"] < 0)
+    leaves = leaves[is_updated[nodes["leaf_id"][leaves]]]
+    leaf_ids = nodes["leaf_id"][leaves]
+    nodes["center"][leaves] = summaries.sums[leaf_ids] / summaries.counts[leaf_ids, None]
+
+    save_json_tree(nodes, tree_filename)
+    save_flat_tree(nodes, flat_tree_file(tree_filename))
+    summaries.save(leaf_summary_file())
+
+    changed = [(first, end) for first, end, _, _ in samples]
+    if len(changed) == 0:
+        print("No subtree has been split again, so none of the trips need to be clustered again.")
+    else:
+        print("The trips in clusters", ", ".join("%d to %d" % (first, end - 1) for first, end in changed),
+              "need to be clustered again.")
+    return changed
+
+
+# Collect the (node index, depth, first leaf id, end leaf id) of the highest subtrees of which the halves drifted apart.
+def find_drifted_subtrees(tree, counts, i, depth, first, subtrees):
+    if tree.lesser[i] < 0:
+        return
+
+    half = 2 ** (tree.depth - depth - 1)
+    nr_lesser = int(counts[first:first + half].sum())
+    nr_greater = int(counts[first + half:first + 2 * half].sum())
+    if abs(nr_lesser - nr_greater) > refresh_tolerance * (nr_lesser + nr_greater):
+        subtrees.append((i, depth, first, first + 2 * half))
+    else:
+        find_drifted_subtrees(tree, counts, tree.lesser[i], depth + 1, first, subtrees)
+        find_drifted_subtrees(tree, counts, tree.greater[i], depth + 1, first + half, subtrees)
+
+
+# The worker processes import this module, so only start building when the module is run as a script.
+# Given the names of new pre-processed taxi files, e.g. "python median_cluster_tree_construction.py trip_data_13.csv",
+# the existing tree is refreshed with them instead of built again.
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        refresh_tree(sys.argv[1:])
+    else:
+        process_files()
+
@@ -1,6 +1,13 @@
-import json
 import os
-from collections import namedtuple
+from itertools import islice
+
+import numpy as np
+
+from chunked_csv import fields_to_floats, join_fields, split_lines, write_rows
+from compressed_io import intermediate_file, open_input, open_output
+from coordinate_cache import BatchCoordinateCache, cache_coordinates, report_cache
+from find_neighborhood import load_district_raster
+from flat_tree import FlatTree, as_flat_tree, load_median_tree
 
 # Location of the pre-processed taxi source files.
 taxi_folder_location = "Z:\\data_engineering\\taxi_pre_processed_trip_data"
@@ -23,13 +30,15 @@ k = 10
 median_cluster_tree_folder = "Z:\\data_engineering"
 median_cluster_tree_file = "median_cluster_tree_k_" + str(k) + ".json"
 
-with open(median_cluster_tree_folder + "\\" + median_cluster_tree_file, 'r') as median_tree_file:
-    data = median_tree_file.read()
-median_tree = json.loads(data, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+# The flat version of the tree is used when it exists, as it is much faster to load and to walk through.
+median_tree = load_median_tree(median_cluster_tree_folder + "\\" + median_cluster_tree_file)
 
 
 # Get the appropriate cluster using the given (sub)tree.
 def get_cluster_id(tree, pos, depth=0):
+    if isinstance(tree, FlatTree):
+        return tree.get_cluster_id(pos)
+
     if tree.lesser_child is not None:
         # Find which subtree the position resides in.
         if pos[depth % 2] < tree.median:
@@ -41,62 +50,221 @@ def get_cluster_id(tree, pos, depth=0):
         return tree.id
 
 
+# Get the cluster of the position given as longitude and latitude strings.
+def find_cluster_id(lon, lat):
+    return get_cluster_id(median_tree, (float(lon), float(lat)))
+
+
+# The districts of the pickup and dropoff positions are looked up in the district raster of find_neighborhood.
+neighborhood_data_folder = "Z:\\data_engineering\\neighborhood_data"
+neighborhood_shape_file = neighborhood_data_folder + "\\neighbourhoods.shp"
+neighborhood_database_file = neighborhood_data_folder + "\\neighbourhoods.dbf"
+
+
+# Get the district raster, which is only read (or built) when it is first needed. The names of the districts are
+# written into the rows as they are, so they cannot hold the separator.
+def get_district_raster():
+    raster = load_district_raster(neighborhood_shape_file, neighborhood_database_file)
+    if any("," in name or "\n" in name for name in raster.names):
+        raise ValueError("The district names in " + neighborhood_database_file + " hold a comma or a newline")
+    return raster
+
+
+# Get the district of the position given as longitude and latitude strings, or the empty string if it is in none.
+def find_district(lon, lat):
+    return get_district_raster().find_districts([float(lon)], [float(lat)])[0]
+
+
+# The clusters and districts of the positions that the line engine has seen, which are cleared for every file.
+cached_cluster_id = cache_coordinates(find_cluster_id)
+cached_district = cache_coordinates(find_district)
+
+# The clusters of the positions that the chunked engine has seen, which is cleared for every file. As the chunked engine
+# has already converted the positions, they are keyed on their values, given as complex numbers lon + lat * 1j.
+cached_cluster_ids = BatchCoordinateCache()
+
+# The chunked engine only looks up the distinct positions of a chunk in the cache when there are at most this many of
+# them per endpoint. The taxi positions are mostly distinct, and are cheaper to look up in the tree as a whole column.
+max_distinct_fraction = 0.5
+
+
+# The engine used to set the clusters.
+#   - "chunked" handles chunks of rows as whole columns, and looks up the clusters of all rows in a chunk at once.
+#   - "line" handles the rows one by one.
+# Both engines produce exactly the same files.
+clustering_engine = "chunked"
+
+# The number of rows the chunked engine loads at once.
+chunk_size = 100000
+
+
+# The headers of the clustered taxi and bike files.
+# The districts of the endpoints are the last two fields, such that the other fields keep their position.
+taxi_header = "taxi_id,start_time,end_time,from_cluster,to_cluster,passenger_count,trip_duration,fare_amount," \
+              "tip_amount,from_district,to_district"
+bike_header = "bike_id,start_time,end_time,from_cluster,to_cluster,trip_duration,from_district,to_district"
+
+
 # For each of the data files, replace the position with the appropriate cluster id.
 def process_taxi_file(_input, _output):
+    _input, _output = intermediate_file(_input), intermediate_file(_output)
     print("Setting clusters for", _input)
 
-    with open(_output, "w") as output_file:
-        with open(_input, "r") as input_file:
-            is_first = True
-
+    with open_output(_output) as output_file:
+        with open_input(_input) as input_file:
             # Write the header of the file.
-            output_file.write("taxi_id,start_time,end_time,from_cluster,to_cluster,passenger_count,"
-                              "trip_duration,fare_amount,tip_amount")
+            output_file.write(taxi_header)
 
-            for line in input_file:
-                if is_first:
-                    is_first = False
-                    continue
+            # Skip the header of the input, and process the taxi rows, which have 11 fields.
+            next(input_file, None)
+            process_rows(input_file, 11, output_file, _input)
 
-                # Select the fields we are interested in.
-                data_fields = line.strip().split(",")
 
-                # Find the clusters and reconstruct the entry.
-                target_fields = data_fields[0:3]
-                target_fields += [get_cluster_id(median_tree, (float(data_fields[3]), float(data_fields[4])))]
-                target_fields += [get_cluster_id(median_tree, (float(data_fields[5]), float(data_fields[6])))]
-                target_fields += data_fields[7:]
+def process_bike_file(_input, _output):
+    _input, _output = intermediate_file(_input), intermediate_file(_output)
+    print("Setting clusters for", _input)
 
-                # Add the entry to the pre-processing file.
-                output_file.write('\n' + ",".join([str(s) for s in target_fields]))
+    with open_output(_output) as output_file:
+        with open_input(_input) as input_file:
+            # Write the header of the file.
+            output_file.write(bike_header)
 
+            # Skip the header of the input, and process the bike rows, which have 8 fields.
+            next(input_file, None)
+            process_rows(input_file, 8, output_file, _input)
 
-def process_bike_file(_input, _output):
-    print("Setting clusters for", _input)
 
-    with open(_output, "w") as output_file:
-        with open(_input, "r") as input_file:
-            is_first = True
+# Process the given rows, which should have the given number of fields, with the chosen engine.
+def process_rows(lines, nr_fields, output_file, name):
+    clear_caches()
 
-            # Write the header of the file.
-            output_file.write("bike_id,start_time,end_time,from_cluster,to_cluster,trip_duration")
+    if clustering_engine == "chunked":
+        process_chunks(lines, nr_fields, output_file)
+    else:
+        process_lines(lines, output_file)
 
-            for line in input_file:
-                if is_first:
-                    is_first = False
-                    continue
+    report_caches(name)
 
-                # Select the fields we are interested in.
-                data_fields = line.strip().split(",")
 
-                # Find the clusters and reconstruct the entry.
-                target_fields = data_fields[0:3]
-                target_fields += [get_cluster_id(median_tree, (float(data_fields[3]), float(data_fields[4])))]
-                target_fields += [get_cluster_id(median_tree, (float(data_fields[5]), float(data_fields[6])))]
-                target_fields += data_fields[7:]
+def clear_caches():
+    global cached_cluster_id, cached_district, cached_cluster_ids
+    cached_cluster_id = cache_coordinates(find_cluster_id)
+    cached_district = cache_coordinates(find_district)
+    cached_cluster_ids = BatchCoordinateCache()
+
+
+def report_caches(name):
+    report_cache(cached_cluster_ids, name)
+    report_cache(cached_cluster_id, name)
+    report_cache(cached_district, name)
+
+
+# Process the given lines one by one, and return the number of lines written.
+def process_lines(lines, output_file):
+    nr_lines = 0
+
+    for line in lines:
+        # Select the fields we are interested in.
+        data_fields = line.strip().split(",")
+
+        # Find the clusters and districts, and reconstruct the entry.
+        target_fields = data_fields[0:3]
+        target_fields += [cached_cluster_id(data_fields[3], data_fields[4])]
+        target_fields += [cached_cluster_id(data_fields[5], data_fields[6])]
+        target_fields += data_fields[7:]
+        target_fields += [cached_district(data_fields[3], data_fields[4])]
+        target_fields += [cached_district(data_fields[5], data_fields[6])]
+
+        # Add the entry to the pre-processing file.
+        output_file.write('\n' + ",".join([str(s) for s in target_fields]))
+        nr_lines += 1
+
+    return nr_lines
+
+
+# Process the lines of the file in chunks of rows, which should have the given number of fields.
+# The lines that cannot be handled as a whole, such as lines with a different number of fields, go through the line loop.
+def process_chunks(input_file, nr_fields, output_file):
+    labels = ChunkLabels()
+
+    while True:
+        lines = list(islice(input_file, chunk_size))
+        if len(lines) == 0:
+            break
+
+        # Convert the pickup and dropoff positions, and find their clusters in one go.
+        buffer, starts, ends, faulty = split_lines(lines, nr_fields)
+        positions, faulty_positions = fields_to_floats(buffer, starts[:, 3:7].reshape(-1), ends[:, 3:7].reshape(-1))
+        positions = positions.reshape(-1, 4)
+        faulty |= faulty_positions.reshape(-1, 4).any(axis=1)
+        keep = ~faulty
+        from_clusters, to_clusters, from_districts, to_districts = labels.find_columns(positions[keep])
+
+        # The output consists of the first three fields, the two clusters, all fields after the positions and the two
+        # districts.
+        output, output_ends = join_fields([(buffer, starts[keep, 0], ends[keep, 2]), from_clusters, to_clusters,
+                                           (buffer, starts[keep, 7], ends[keep, nr_fields - 1]), from_districts,
+                                           to_districts])
+        write_rows(output, output_ends, keep, faulty, lambda i: process_lines([lines[i]], output_file), output_file)
+
+
+# The text of every cluster id and of the name of every district, from which the cluster and district columns of the
+# chunked engine are taken.
+class ChunkLabels:
+    def __init__(self):
+        self.tree = as_flat_tree(median_tree)
+        self.ids = label_source([str(i) for i in range(0, max(self.tree.leaf_ids) + 1)])
+
+        # The last name is the empty name of the positions outside all districts.
+        self.raster = get_district_raster()
+        self.names = label_source(self.raster.names)
+
+    # Find the clusters and districts of the given pickup and dropoff positions of a chunk, and return the from and to
+    # cluster columns and the from and to district columns for join_fields.
+    def find_columns(self, positions):
+        from_clusters, to_clusters = find_chunk_clusters(self.tree, positions)
+
+        # The index -1 of the positions outside all districts is the index of the empty name.
+        districts = self.raster.find_district_ids(positions[:, [0, 2]].reshape(-1),
+                                                  positions[:, [1, 3]].reshape(-1)).reshape(-1, 2)
+
+        id_buffer, id_starts, id_ends = self.ids
+        name_buffer, name_starts, name_ends = self.names
+        return (id_buffer, id_starts[from_clusters], id_ends[from_clusters]), \
+            (id_buffer, id_starts[to_clusters], id_ends[to_clusters]), \
+            (name_buffer, name_starts[districts[:, 0]], name_ends[districts[:, 0]]), \
+            (name_buffer, name_starts[districts[:, 1]], name_ends[districts[:, 1]])
+
+
+# Place the given labels after each other, and return the buffer with the start and end of every label.
+def label_source(labels):
+    lengths = [len(label.encode("utf-8")) for label in labels]
+    buffer = np.frombuffer("".join(labels).encode("utf-8"), dtype=np.uint8)
+    ends = np.cumsum(lengths, dtype=np.int64)
+    return buffer, ends - lengths, ends
+
+
+# Find the clusters of the pickup and dropoff positions of the given rows of a chunk.
+# The distinct positions are looked up through the cache, and only the positions that are not cached are looked up in
+# the tree.
+def find_chunk_clusters(tree, positions):
+    lon = positions[:, [0, 2]].reshape(-1)
+    lat = positions[:, [1, 3]].reshape(-1)
+    keys = lon + lat * 1j
+    distinct_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    if len(distinct_keys) > max_distinct_fraction * len(keys):
+        clusters = tree.get_cluster_ids(lon, lat)
+        cached_cluster_ids.misses += len(keys)
+    else:
+        # The endpoints of which the position occurs before in the chunk count as hits as well.
+        cached_cluster_ids.hits += len(keys) - len(distinct_keys)
+        distinct_clusters = cached_cluster_ids.lookup(
+            distinct_keys.tolist(), lambda missing: tree.get_cluster_ids(lon[first[missing]], lat[first[missing]]))
+        clusters = np.array(distinct_clusters, dtype=np.int64)[inverse.reshape(-1)]
 
-                # Add the entry to the pre-processing file.
-                output_file.write('\n' + ",".join([str(s) for s in target_fields]))
+    clusters = clusters.reshape(-1, 2)
+    return clusters[:, 0], clusters[:, 1]
 
 
 def process_taxi_files():
@@ -110,7 +278,7 @@ def process_bike_files():
 
 
 def process_files():
-    if any(os.path.isfile(filename) for filename in taxi_output_files):
+    if any(os.path.isfile(intermediate_file(filename)) for filename in taxi_output_files):
         answer = ""
         while answer not in ["y", "n"]:
             answer = input("Clustered taxi files already exist. Are you sure you want to continue [Y/N]? ").lower()
@@ -119,7 +287,7 @@ def process_files():
     else:
         process_taxi_files()
 
-    if any(os.path.isfile(filename) for filename in bike_output_files):
+    if any(os.path.isfile(intermediate_file(filename)) for filename in bike_output_files):
         answer = ""
         while answer not in ["y", "n"]:
             answer = input("Clustered bike files already exist. Are you sure you want to continue [Y/N]? ").lower()
@@ -129,4 +297,6 @@ def process_files():
         process_bike_files()
 
 
-process_files()
+# The fused pipeline imports this module, so only process the files when the module is run as a script.
+if __name__ == "__main__":
+    process_files()
@@ -1,5 +1,16 @@
-from datetime import datetime
+import io
 import os
+import shutil
+from itertools import islice
+
+import numpy as np
+
+from chunked_csv import field_characters, fields_equal, fields_to_floats, fields_to_times, join_fields, split_lines, \
+    split_text, write_rows
+from compressed_io import compression_of, intermediate_file, open_input, open_output
+from coordinate_cache import cache_coordinates, report_cache
+from time_codec import parse_time
+from worker_pool import process_in_parallel
 
 # What do we want to do in the pre-processing step?
 #
@@ -58,10 +69,9 @@ taxi_fare_files = [taxi_trip_fare_folder_location + "\\trip_fare_" + str(i) + ".
 taxi_output_folder_location = "Z:\\data_engineering\\taxi_pre_processed_trip_data"
 taxi_output_files = [taxi_output_folder_location + "\\trip_data_" + str(i) + ".csv" for i in range(1, 13)]
 
-# Data used to determine the validity of entries.
-time_format = '%Y-%m-%d %H:%M:%S'
-start_time = datetime.strptime('2013-06-01 00:00:01', time_format)
-end_time = datetime.strptime('2014-01-01 00:09:33', time_format)
+# Data used to determine the validity of entries, in epoch seconds.
+start_time = parse_time('2013-06-01 00:00:01')
+end_time = parse_time('2014-01-01 00:09:33')
 
 
 # Check whether the given position is close to New York.
@@ -69,71 +79,545 @@ def is_valid_position(lon, lat):
     return (float(lon) - -74.00597) ** 2 + (float(lat) - 40.71278) ** 2 <= 4
 
 
-# Do all pre-processing cleanup on each separate data file.
-def pre_process_taxi_files():
-    for i in range(0, len(taxi_output_files)):
-        pre_process_taxi_file(i)
+# The validity of the positions that the line engine has seen, which is cleared for every file.
+cached_is_valid_position = cache_coordinates(is_valid_position)
 
 
-def pre_process_taxi_file(month_id):
-    print("Pre-processing", taxi_trip_files[month_id], "and", taxi_fare_files[month_id], "into", taxi_output_files[month_id])
+# Check which of the positions in the given longitude and latitude arrays are close to New York.
+def are_valid_positions(lon, lat):
+    return (lon - -74.00597) ** 2 + (lat - 40.71278) ** 2 <= 4
 
-    with open(taxi_output_files[month_id], "w") as output_file:
-        with open(taxi_trip_files[month_id], "r") as data_file, open(taxi_fare_files[month_id], "r") as fare_file:
-            is_first = True
 
-            # Write the header of the file.
-            # Note that some entries are not in the order specified in the file!
-            output_file.write("taxi_id,start_time,end_time,pickup_longitude,pickup_latitude,dropoff_longitude,"
-                              "dropoff_latitude,passenger_count,trip_duration,fare_amount,tip_amount")
+# The engine used to process the rows of a file:
+#   - "chunked" loads blocks of rows into column arrays, and applies the filters to entire columns at once.
+#   - "line" is the original loop, which handles the rows one by one.
+# Both engines produce exactly the same output files.
+pre_processing_engine = "chunked"
+
+# The number of rows the chunked engine loads at once.
+# Larger chunks spend more time on memory traffic than they save on overhead, so there is little use in going higher.
+chunk_size = 100000
+
 
-            if month_id < 5:
-                # We know already that these months are excluded, so skip.
-                return
+# The size of the blocks in which files are scanned for newlines.
+scan_block_size = 1 << 24
 
-            for x, y in zip(data_file, fare_file):
-                if is_first:
-                    is_first = False
+
+# Count the number of lines in the file, in the same way as iterating over the lines of the file does.
+def count_lines(filename):
+    nr_lines = 0
+    last_block = b""
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(scan_block_size), b""):
+            nr_lines += block.count(b"\n")
+            last_block = block
+
+    # The last line does not necessarily end with a newline.
+    return nr_lines + (len(last_block) > 0 and not last_block.endswith(b"\n"))
+
+
+# Find the byte offset at which each of the given (ascending) line ordinals starts.
+# Ordinals beyond the last line are placed at the end of the file.
+def find_line_starts(filename, line_ordinals):
+    offsets = []
+    nr_newlines = 0
+    position = 0
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(scan_block_size), b""):
+            newlines = None
+            block_newlines = block.count(b"\n")
+
+            # Line ordinal i starts right after the i-th newline.
+            while len(offsets) < len(line_ordinals) and line_ordinals[len(offsets)] <= nr_newlines + block_newlines:
+                ordinal = line_ordinals[len(offsets)]
+                if ordinal == 0:
+                    offsets.append(0)
                     continue
+                if newlines is None:
+                    newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+                offsets.append(position + int(newlines[ordinal - nr_newlines - 1]) + 1)
 
-                # Select the fields we are interested in.
-                fields_x = x.strip().split(",")
-                fields_y = y.strip().split(",")
-
-                # x: we are only interested in the fields 0, 5, 6, 7, 8, 10, 11, 12 and 13.
-                # y: we are only interested in the fields 5, 8.
-                target_fields = fields_x[0:1] + fields_x[5:7] + fields_x[10:] + fields_x[7:9] + fields_y[5:6] + fields_y[8:9]
-
-                try:
-                    # Check whether the given entry is valid or not, starting with the empty entries.
-                    if any(fields_x[i] == "" for i in [10, 11, 12, 13]):
-                        # One of the positions is not set, so skip.
-                        continue
-
-                    if fields_x[9] == ".00":
-                        # No distance traveled.
-                        continue
-
-                    # Proceed with the time and distance requirements.
-                    if datetime.strptime(fields_x[5], time_format) >= start_time \
-                            and datetime.strptime(fields_x[6], time_format) <= end_time \
-                            and is_valid_position(fields_x[10], fields_x[11]) \
-                            and is_valid_position(fields_x[12], fields_x[13]):
-
-                        # Add the entry to the pre-processing file.
-                        output_file.write('\n' + ",".join(target_fields))
-                except ValueError:
-                    print("Value error on line \"" + x.strip() + "\"")
-
-
-if any(os.path.isfile(filename) for filename in taxi_output_files):
-    answer = ""
-    while answer not in ["y", "n"]:
-        answer = input("Pre-processed taxi files already exist. Are you sure you want to continue [Y/N]? ").lower()
-    if answer == "y":
-        pre_process_taxi_files()
-else:
-    pre_process_taxi_files()
+            nr_newlines += block_newlines
+            position += len(block)
+
+    return offsets + [position] * (len(line_ordinals) - len(offsets))
+
+
+# Report the number of accepted and rejected rows of each of the output files.
+# The counts can also hold the number of dropped duplicates, which are part of the rejected rows.
+def report_counts(output_files, counts):
+    for filename, file_counts in zip(output_files, counts):
+        print(describe_counts(file_counts), "for", intermediate_file(filename))
+    print(describe_counts([sum(c) for c in zip(*counts)]), "in total")
+
+
+def describe_counts(counts):
+    description = "Accepted " + str(counts[0]) + " and rejected " + str(counts[1]) + " rows"
+    if len(counts) > 2:
+        description += ", of which " + str(counts[2]) + " duplicates"
+    return description
+
+
+# The same taxi trip is often recorded more than once, with the same medallion, pickup time and dropoff time.
+# Such duplicates are dropped while writing the pre-processed files, keeping only the first occurrence.
+remove_duplicate_trips = True
+
+# The trips are roughly ordered on time, so we only remember the trips that started at most this many seconds before
+# the latest trip, which keeps the memory bounded. Duplicates that are further apart than this are not detected.
+duplicate_window = 3600
+
+
+# Drops the trips of which the key has been seen before. The key of a trip consists of its taxi id, start time and end
+# time, where the times are compared as epoch seconds.
+#
+# Conceptually, the keys are kept in a set for each time slot of the window size, based on the start time in the key.
+# Duplicates always end up in the same slot, and whenever a trip starts in a later slot than all trips before it, the
+# slots before the previous one are dropped as a whole. A key is thus found again as long as no trip in between moved
+# the latest slot to two or more slots past its own slot. Rather than keeping the sets, every key is marked with the
+# latest slot at the time it was seen if that was already two or more slots past it, or with -1 otherwise. Two trips
+# with the same key then find each other exactly when they have the same mark, so the trips of a whole chunk are checked
+# at once by finding the first occurrence of every key and mark. The keys that can no longer be found are dropped.
+#
+# The filter can be written to as an output file, with the rows of pre-processed text that are each preceded by a
+# newline, which are then split as whole columns, or be asked to check the columns of a chunk with find_duplicates.
+class DuplicateFilter:
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.nr_duplicates = 0
+
+        # The keys that can still be found again, with their marks, and the latest slot.
+        self.taxi_ids = np.zeros(0, dtype="S1")
+        self.start_times = np.zeros(0, dtype=np.int64)
+        self.end_times = np.zeros(0, dtype=np.int64)
+        self.marks = np.zeros(0, dtype=np.int64)
+        self.latest_slot = -1
+
+        # The text that has been written, but that has not been checked yet, and the number of lines in it.
+        self.pending = []
+        self.nr_pending_lines = 0
+
+    # Check which of the given trips, given in the order in which they are written, have been seen before, and
+    # remember the others. The taxi ids are given as byte strings.
+    def find_duplicates(self, taxi_ids, start_times, end_times):
+        slots = start_times // duplicate_window
+        latest_slots = np.maximum.accumulate(np.concatenate(([self.latest_slot], slots)))[1:]
+        marks = np.where(latest_slots >= slots + 2, latest_slots, -1)
+
+        # The keys that are remembered come first, such that the first occurrence of a key is the one that was seen first.
+        nr_remembered = len(self.taxi_ids)
+        taxi_ids = np.concatenate((self.taxi_ids, taxi_ids))
+        keys = np.zeros(len(taxi_ids), dtype=[("taxi_id", taxi_ids.dtype), ("start_time", np.int64),
+                                              ("end_time", np.int64), ("mark", np.int64)])
+        keys["taxi_id"] = taxi_ids
+        keys["start_time"] = np.concatenate((self.start_times, start_times))
+        keys["end_time"] = np.concatenate((self.end_times, end_times))
+        keys["mark"] = np.concatenate((self.marks, marks))
+
+        is_duplicate = np.ones(len(keys), dtype=bool)
+        is_duplicate[np.unique(keys, return_index=True)[1]] = False
+        self.nr_duplicates += int(is_duplicate.sum())
+
+        # Only remember the keys that can be found again, which are those of which the slot is in the window, and those
+        # that have been seen since the latest slot was reached.
+        if len(latest_slots) > 0:
+            self.latest_slot = int(latest_slots[-1])
+        keys = keys[~is_duplicate]
+        keys = keys[(keys["start_time"] // duplicate_window + 2 > self.latest_slot) | (keys["mark"] == self.latest_slot)]
+        self.taxi_ids = keys["taxi_id"]
+        self.start_times = keys["start_time"]
+        self.end_times = keys["end_time"]
+        self.marks = keys["mark"]
+        return is_duplicate[nr_remembered:]
+
+    # Write the given lines, which are each preceded by a newline. The lines are checked a chunk at a time.
+    def write(self, text):
+        self.pending.append(text)
+        self.nr_pending_lines += text.count("\n")
+        if self.nr_pending_lines >= chunk_size:
+            self.flush(complete_lines_only=True)
+
+    # Check and write the lines that have been written, except for the last line if it may not be complete yet.
+    def flush(self, complete_lines_only=False):
+        text = "".join(self.pending)
+        end = text.rfind("\n") if complete_lines_only else len(text)
+        self.pending = [text[end:]] if end > 0 else [text]
+        self.nr_pending_lines = self.pending[0].count("\n")
+        if end > 0:
+            self.write_lines(text[:end])
+
+    # Check and write the given complete lines, which are each preceded by a newline.
+    def write_lines(self, text):
+        buffer, starts, ends, faulty = split_text(text[1:], text.count("\n"), 11)
+        width = max(int((ends[:, 0] - starts[:, 0]).max(initial=0)), 1)
+        taxi_ids = np.ascontiguousarray(field_characters(buffer, starts[:, 0], ends[:, 0], width)).view("S" + str(width))
+        taxi_ids = taxi_ids[:, 0]
+        times, faulty_times = fields_to_times(buffer, starts[:, 1:3].reshape(-1), ends[:, 1:3].reshape(-1))
+        times = times.reshape(-1, 2)
+        faulty |= faulty_times.reshape(-1, 2).any(axis=1)
+
+        # The lines that cannot be split as a whole are split one by one.
+        lines = None
+        if faulty.any():
+            lines = text.split("\n")[1:]
+            taxi_ids = taxi_ids.astype(object)
+            for i in np.flatnonzero(faulty).tolist():
+                fields = lines[i].split(",", 3)
+                taxi_ids[i] = fields[0].encode("utf-8")
+                times[i] = (parse_time(fields[1]), parse_time(fields[2]))
+            taxi_ids = taxi_ids.astype(bytes)
+
+        is_duplicate = self.find_duplicates(taxi_ids, times[:, 0], times[:, 1])
+        if not is_duplicate.any():
+            self.output_file.write(text)
+            return
+
+        lines = lines if lines is not None else text.split("\n")[1:]
+        self.output_file.write("".join("\n" + line for line, duplicate in zip(lines, is_duplicate) if not duplicate))
+
+
+# We know already that these taxi months are excluded, so we skip them.
+# Their output files only contain the header.
+excluded_taxi_months = [0, 1, 2, 3, 4]
+
+
+# The header of the pre-processed taxi files.
+# Note that some entries are not in the order specified in the file!
+taxi_header = "taxi_id,start_time,end_time,pickup_longitude,pickup_latitude,dropoff_longitude,dropoff_latitude," \
+              "passenger_count,trip_duration,fare_amount,tip_amount"
+
+# The number of parts into which each taxi month is split, such that a single month is processed by multiple workers.
+# The parts are ranges of whole lines, which start at the same line ordinals in the trip and fare file, so the trip and
+# fare lines stay paired. With a single part, every month is processed by one worker as a whole.
+# Compressed inputs cannot be read from an offset, so they are always processed as a whole.
+number_of_taxi_parts = 1
+
+
+# Do all pre-processing cleanup on each separate data file.
+def pre_process_taxi_files():
+    if number_of_taxi_parts <= 1 or any(compression_of(filename) for filename in taxi_trip_files + taxi_fare_files):
+        counts = process_in_parallel(pre_process_taxi_file, range(0, len(taxi_output_files)))
+    else:
+        counts = pre_process_taxi_file_parts()
+    report_counts(taxi_output_files, counts)
+    return counts
+
+
+# Pre-process a single month of taxi data, and return the number of accepted, rejected and duplicate rows.
+def pre_process_taxi_file(month_id):
+    output_filename = intermediate_file(taxi_output_files[month_id])
+    print("Pre-processing", taxi_trip_files[month_id], "and", taxi_fare_files[month_id], "into", output_filename)
+
+    with open_output(output_filename) as output_file:
+        with open_input(taxi_trip_files[month_id]) as data_file, open_input(taxi_fare_files[month_id]) as fare_file:
+            # Write the header of the file.
+            output_file.write(taxi_header)
+
+            if month_id in excluded_taxi_months:
+                return 0, 0, 0
+
+            # Skip the headers of both files.
+            next(data_file, None)
+            next(fare_file, None)
+
+            return pre_process_taxi_rows(data_file, fare_file, output_file)
+
+
+# Pre-process all taxi months split into parts, and return the number of accepted, rejected and duplicate rows of each
+# month.
+# The parts of all months are processed by the same pool of workers, after which the pieces are joined in order.
+def pre_process_taxi_file_parts():
+    month_ids = range(0, len(taxi_output_files))
+    parts = process_in_parallel(split_taxi_file, month_ids)
+    part_counts = process_in_parallel(pre_process_taxi_part, [part for month_parts in parts for part in month_parts])
+
+    counts = []
+    for month_id, month_parts in zip(month_ids, parts):
+        output_filename = intermediate_file(taxi_output_files[month_id])
+        print("Joining", len(month_parts), "parts into", output_filename)
+        with open_output(output_filename) as output_file:
+            output_file.write(taxi_header)
+
+            # The duplicates are removed from the joined parts, such that they are also found across the parts.
+            duplicates = DuplicateFilter(output_file) if remove_duplicate_trips else None
+            for part in month_parts:
+                with open(taxi_part_file(part), "r") as part_file:
+                    if duplicates is None:
+                        shutil.copyfileobj(part_file, output_file)
+                    else:
+                        for block in iter(lambda: part_file.read(scan_block_size), ""):
+                            duplicates.write(block)
+                os.remove(taxi_part_file(part))
+            if duplicates is not None:
+                duplicates.flush()
+
+        month_counts = part_counts[:len(month_parts)]
+        part_counts = part_counts[len(month_parts):]
+        counts.append(remove_counted_duplicates([sum(c[i] for c in month_counts) for i in range(0, 2)], duplicates))
+    return counts
+
+
+# Split a taxi month into parts of about the same number of lines.
+# Every part is given as (month id, part id, trip file offset, fare file offset, number of lines).
+def split_taxi_file(month_id):
+    if month_id in excluded_taxi_months:
+        return []
+
+    # Like zip, we stop as soon as one of the files runs out of lines. The first line of both files is the header.
+    nr_lines = min(count_lines(taxi_trip_files[month_id]), count_lines(taxi_fare_files[month_id])) - 1
+    if nr_lines <= 0:
+        return []
+
+    ordinals = [1 + nr_lines * i // number_of_taxi_parts for i in range(0, number_of_taxi_parts + 1)]
+    trip_offsets = find_line_starts(taxi_trip_files[month_id], ordinals)
+    fare_offsets = find_line_starts(taxi_fare_files[month_id], ordinals)
+    return [(month_id, i, trip_offsets[i], fare_offsets[i], ordinals[i + 1] - ordinals[i])
+            for i in range(0, number_of_taxi_parts)]
+
+
+# The file in which the output of a part of a taxi month is stored until it is joined.
+def taxi_part_file(part):
+    return taxi_output_files[part[0]] + ".part" + str(part[1])
+
+
+# Pre-process a part of a taxi month, and return the number of accepted, rejected and duplicate rows.
+def pre_process_taxi_part(part):
+    month_id, part_id, trip_offset, fare_offset, nr_lines = part
+    print("Pre-processing part", part_id, "of", taxi_trip_files[month_id], "and", taxi_fare_files[month_id])
+
+    with open(taxi_part_file(part), "w") as output_file:
+        with open_input(taxi_trip_files[month_id], offset=trip_offset) as data_file, \
+                open_input(taxi_fare_files[month_id], offset=fare_offset) as fare_file:
+            return pre_process_taxi_rows(islice(data_file, nr_lines), islice(fare_file, nr_lines), output_file,
+                                         remove_duplicates=False)
+
+
+# Process the given trip and fare lines, and return the number of accepted, rejected and duplicate rows.
+# The parts of a split month are processed without removing the duplicates, which are removed when they are joined.
+def pre_process_taxi_rows(data_lines, fare_lines, output_file, remove_duplicates=None):
+    global cached_is_valid_position
+    cached_is_valid_position = cache_coordinates(is_valid_position)
+
+    if remove_duplicates is None:
+        remove_duplicates = remove_duplicate_trips
+    duplicates = DuplicateFilter(output_file) if remove_duplicates else None
+
+    if pre_processing_engine == "chunked":
+        nr_accepted, nr_rejected = pre_process_taxi_chunks(data_lines, fare_lines, output_file, duplicates)
+    elif duplicates is not None:
+        nr_accepted, nr_rejected = pre_process_taxi_lines(zip(data_lines, fare_lines), duplicates)
+        duplicates.flush()
+    else:
+        nr_accepted, nr_rejected = pre_process_taxi_lines(zip(data_lines, fare_lines), output_file)
+
+    report_cache(cached_is_valid_position, "the taxi rows")
+    return remove_counted_duplicates((nr_accepted, nr_rejected), duplicates)
+
+
+# Move the duplicates that the given filter, if any, has dropped from the accepted to the rejected rows, and return the
+# number of accepted, rejected and duplicate rows.
+def remove_counted_duplicates(counts, duplicates):
+    nr_duplicates = duplicates.nr_duplicates if duplicates is not None else 0
+    return counts[0] - nr_duplicates, counts[1] + nr_duplicates, nr_duplicates
+
+
+# Process the given pairs of trip and fare lines one by one, and return the number of accepted and rejected rows.
+def pre_process_taxi_lines(line_pairs, output_file):
+    nr_accepted = 0
+    nr_rejected = 0
+
+    for x, y in line_pairs:
+        nr_rejected += 1
+
+        # Select the fields we are interested in.
+        fields_x = x.strip().split(",")
+        fields_y = y.strip().split(",")
+
+        # x: we are only interested in the fields 0, 5, 6, 7, 8, 10, 11, 12 and 13.
+        # y: we are only interested in the fields 5, 8.
+        target_fields = fields_x[0:1] + fields_x[5:7] + fields_x[10:] + fields_x[7:9] + fields_y[5:6] + fields_y[8:9]
+
+        try:
+            # Check whether the given entry is valid or not, starting with the empty entries.
+            if any(fields_x[i] == "" for i in [10, 11, 12, 13]):
+                # One of the positions is not set, so skip.
+                continue
+
+            if fields_x[9] == ".00":
+                # No distance traveled.
+                continue
+
+            # Proceed with the time and distance requirements.
+            if parse_time(fields_x[5]) >= start_time \
+                    and parse_time(fields_x[6]) <= end_time \
+                    and cached_is_valid_position(fields_x[10], fields_x[11]) \
+                    and cached_is_valid_position(fields_x[12], fields_x[13]):
+
+                # Add the entry to the pre-processing file.
+                output_file.write('\n' + ",".join(target_fields))
+                nr_accepted += 1
+                nr_rejected -= 1
+        except ValueError:
+            print("Value error on line \"" + x.strip() + "\"")
+
+    return nr_accepted, nr_rejected
+
+
+# The selected rows of a chunk of lines. The valid lines are given in the output format as columns for join_fields, next
+# to their positions (pickup longitude, pickup latitude, dropoff longitude, dropoff latitude) and, if they have been
+# parsed, their start times. The faulty lines are handled by the line loop, of which the output is kept by line index.
+class RowChunk:
+    def __init__(self, columns, keep, faulty, faulty_texts, positions, start_times=None):
+        self.columns = columns
+        self.keep = keep
+        self.faulty = faulty
+        self.faulty_texts = faulty_texts
+        self.positions = positions
+        self.start_times = start_times
+
+    # Write the rows of the chunk in their original order, and return the number of rows written.
+    def write_to(self, output_file):
+        output, output_ends = join_fields(self.columns)
+        return write_rows(output, output_ends, self.keep, self.faulty,
+                          lambda i: write_faulty_text(self.faulty_texts, i, output_file), output_file)
+
+    # Only keep the valid rows that are not dropped by the given mask.
+    def drop_valid_rows(self, is_dropped):
+        self.columns = [(buffer, starts[~is_dropped], ends[~is_dropped]) for buffer, starts, ends in self.columns]
+        self.positions = self.positions[~is_dropped]
+        if self.start_times is not None:
+            self.start_times = self.start_times[~is_dropped]
+        self.keep = self.keep.copy()
+        self.keep[np.flatnonzero(self.keep)[is_dropped]] = False
+
+
+# Write the output of the faulty line with the given index, if it has been accepted, and return the number of lines
+# written.
+def write_faulty_text(faulty_texts, i, output_file):
+    if i not in faulty_texts:
+        return 0
+    output_file.write(faulty_texts[i])
+    return 1
+
+
+# Hand a chunk of rows over to the output file if it takes chunks as they are, such as the fused pipeline does, and
+# write its rows otherwise. Returns the number of rows written.
+def write_chunk(chunk, output_file):
+    if hasattr(output_file, "write_chunk"):
+        return output_file.write_chunk(chunk)
+    return chunk.write_to(output_file)
+
+
+# Process the given faulty lines of a chunk with the given line loop, and return the output of the accepted ones by
+# line index.
+def process_faulty_lines(faulty, process_lines):
+    faulty_texts = {}
+    for i in np.flatnonzero(faulty).tolist():
+        text_file = io.StringIO()
+        process_lines(i, text_file)
+        if text_file.tell() > 0:
+            faulty_texts[i] = text_file.getvalue()
+    return faulty_texts
+
+
+# Process the trip and fare files in chunks of rows, and return the number of accepted and rejected rows.
+# If a duplicate filter is given, the duplicates are dropped from the output, but they are counted as accepted rows.
+def pre_process_taxi_chunks(data_file, fare_file, output_file, duplicates=None):
+    nr_accepted = 0
+    nr_lines = 0
+
+    while True:
+        lines_x = list(islice(data_file, chunk_size))
+        lines_y = list(islice(fare_file, len(lines_x)))
+        if len(lines_x) == 0 or len(lines_y) == 0:
+            break
+
+        # Like zip, we stop as soon as one of the files runs out of lines.
+        lines_x = lines_x[:len(lines_y)]
+
+        columns, keep, faulty, positions, keys = select_taxi_rows(lines_x, lines_y)
+        faulty_texts = process_faulty_lines(
+            faulty, lambda i, text_file: pre_process_taxi_lines([(lines_x[i], lines_y[i])], text_file))
+        chunk = RowChunk(columns, keep, faulty, faulty_texts, positions, keys[1])
+        if duplicates is not None:
+            nr_accepted += drop_duplicate_rows(chunk, keys, duplicates)
+
+        nr_accepted += write_chunk(chunk, output_file)
+        nr_lines += len(lines_x)
+
+        if len(lines_y) < chunk_size:
+            break
+
+    return nr_accepted, nr_lines - nr_accepted
+
+
+# Drop the rows of a chunk of which the trip has been seen before by the given duplicate filter, given the taxi ids,
+# start times and end times of its valid rows. The valid rows and the accepted faulty rows are checked in their original
+# order. Returns the number of dropped rows.
+def drop_duplicate_rows(chunk, keys, duplicates):
+    taxi_ids, start_times, end_times = keys
+    rows = np.flatnonzero(chunk.keep)
+    faulty_rows = sorted(chunk.faulty_texts)
+    if len(faulty_rows) > 0:
+        faulty_fields = [chunk.faulty_texts[i][1:].split(",", 3) for i in faulty_rows]
+        rows = np.concatenate((rows, faulty_rows))
+        taxi_ids = np.concatenate((taxi_ids, np.array([fields[0].encode("utf-8") for fields in faulty_fields])))
+        start_times = np.concatenate((start_times, [parse_time(fields[1]) for fields in faulty_fields]))
+        end_times = np.concatenate((end_times, [parse_time(fields[2]) for fields in faulty_fields]))
+    order = np.argsort(rows, kind="stable")
+    is_duplicate = np.zeros(len(rows), dtype=bool)
+    is_duplicate[order] = duplicates.find_duplicates(taxi_ids[order], start_times[order], end_times[order])
+
+    nr_valid = np.count_nonzero(chunk.keep)
+    chunk.drop_valid_rows(is_duplicate[:nr_valid])
+    for i in rows[nr_valid:][is_duplicate[nr_valid:]].tolist():
+        del chunk.faulty_texts[i]
+    return int(is_duplicate.sum())
+
+
+# Apply all the filters to a chunk of trip and fare lines.
+# Returns the valid lines in the output format as columns for join_fields, a mask of the valid lines, a mask of the
+# faulty lines, the positions of the valid lines, and their taxi ids, start times and end times.
+def select_taxi_rows(lines_x, lines_y):
+    buffer_x, starts_x, ends_x, faulty = split_lines(lines_x, 14)
+    buffer_y, starts_y, ends_y, faulty_y = split_lines(lines_y, 11)
+    faulty |= faulty_y
+
+    # Entries with an empty position or no distance traveled are skipped.
+    candidates = np.flatnonzero(~(faulty | (starts_x[:, 10:14] == ends_x[:, 10:14]).any(axis=1)
+                                  | fields_equal(buffer_x, starts_x[:, 9], ends_x[:, 9], b".00")))
+    starts_x, ends_x = starts_x[candidates], ends_x[candidates]
+
+    # Proceed with the time and distance requirements.
+    start_times, faulty_start = fields_to_times(buffer_x, starts_x[:, 5], ends_x[:, 5])
+    end_times, faulty_end = fields_to_times(buffer_x, starts_x[:, 6], ends_x[:, 6])
+    positions, faulty_positions = fields_to_floats(buffer_x, starts_x[:, 10:14].reshape(-1), ends_x[:, 10:14].reshape(-1))
+    positions = positions.reshape(-1, 4)
+    faulty_candidates = faulty_start | faulty_end | faulty_positions.reshape(-1, 4).any(axis=1)
+    valid = ~faulty_candidates & (start_times >= start_time) & (end_times <= end_time) \
+        & are_valid_positions(positions[:, 0], positions[:, 1]) \
+        & are_valid_positions(positions[:, 2], positions[:, 3])
+
+    keep = np.zeros(len(lines_x), dtype=bool)
+    keep[candidates[valid]] = True
+    faulty[candidates[faulty_candidates]] = True
+
+    # x: we are only interested in the fields 0, 5, 6, 7, 8, 10, 11, 12 and 13.
+    # y: we are only interested in the fields 5, 8.
+    starts_x, ends_x = starts_x[valid], ends_x[valid]
+    starts_y, ends_y = starts_y[keep], ends_y[keep]
+    columns = [
+        (buffer_x, starts_x[:, 0], ends_x[:, 0]),
+        (buffer_x, starts_x[:, 5], ends_x[:, 6]),
+        (buffer_x, starts_x[:, 10], ends_x[:, 13]),
+        (buffer_x, starts_x[:, 7], ends_x[:, 8]),
+        (buffer_y, starts_y[:, 5], ends_y[:, 5]),
+        (buffer_y, starts_y[:, 8], ends_y[:, 8])
+    ]
+
+    # The keys of the valid lines, of which the taxi ids are the characters of the first field.
+    width = max(int((ends_x[:, 0] - starts_x[:, 0]).max(initial=0)), 1)
+    taxi_ids = np.ascontiguousarray(field_characters(buffer_x, starts_x[:, 0], ends_x[:, 0], width)).view("S" + str(width))
+    return columns, keep, faulty, positions[valid], (taxi_ids[:, 0], start_times[valid], end_times[valid])
 
 
 # In the city bike dataset, we have the following set of fields:
@@ -163,64 +647,166 @@ bike_output_folder_location = "Z:\\data_engineering\\bike_pre_processed_trip_dat
 bike_output_files = [bike_output_folder_location + "\\trip_data_" + str(i) + ".csv" for i in range(6, 13)]
 
 
+# The header of the pre-processed bike files.
+# Note that some entries are not in the order specified in the file!
+bike_header = "bike_id,start_time,end_time,pickup_longitude,pickup_latitude,dropoff_longitude,dropoff_latitude," \
+              "trip_duration"
+
+
 # Do all pre-processing cleanup on each separate data file.
 def pre_process_bike_files():
-    for i in range(0, len(bike_output_files)):
-        pre_process_bike_file(i)
+    counts = process_in_parallel(pre_process_bike_file, range(0, len(bike_output_files)))
+    report_counts(bike_output_files, counts)
+    return counts
 
 
+# Pre-process a single month of bike data, and return the number of accepted and rejected rows.
 def pre_process_bike_file(month_id):
-    print("Pre-processing", bike_trip_files[month_id], "into", bike_output_files[month_id])
-
-    with open(bike_output_files[month_id], "w") as output_file:
-        with open(bike_trip_files[month_id], "r") as data_file:
-            is_first = True
+    output_filename = intermediate_file(bike_output_files[month_id])
+    print("Pre-processing", bike_trip_files[month_id], "into", output_filename)
 
+    with open_output(output_filename) as output_file:
+        with open_input(bike_trip_files[month_id]) as data_file:
             # Write the header of the file.
-            # Note that some entries are not in the order specified in the file!
-            output_file.write("bike_id,start_time,end_time,pickup_longitude,pickup_latitude,dropoff_longitude,dropoff_latitude,trip_duration")
+            output_file.write(bike_header)
+
+            # Skip the header.
+            next(data_file, None)
+
+            return pre_process_bike_rows(data_file, output_file)
+
+
+# Process the given bike lines with the chosen engine, and return the number of accepted and rejected rows.
+def pre_process_bike_rows(lines, output_file):
+    global cached_is_valid_position
+    cached_is_valid_position = cache_coordinates(is_valid_position)
+
+    if pre_processing_engine == "chunked":
+        counts = pre_process_bike_chunks(lines, output_file)
+    else:
+        counts = pre_process_bike_lines(lines, output_file)
+
+    report_cache(cached_is_valid_position, "the bike rows")
+    return counts
 
-            for x in data_file:
-                if is_first:
-                    is_first = False
-                    continue
 
-                # TODO do we have any cleanups for bike data?
+# Process the given bike lines one by one, and return the number of accepted and rejected rows.
+def pre_process_bike_lines(lines, output_file):
+    nr_accepted = 0
+    nr_rejected = 0
 
-                # Select the fields we are interested in.
-                # Note that we should remove ", which is present on every line.
-                fields_x = x.strip().replace("\"", "").split(",")
+    for x in lines:
+        nr_rejected += 1
 
-                # We are only interested in the fields 0, 1, 2, 5, 6, 9, 10 and 11.
-                target_fields = fields_x[11:12] + fields_x[1:3] + fields_x[6:7] + fields_x[5:6] + fields_x[10:11] + \
-                                fields_x[9:10] + fields_x[0:1]
+        # TODO do we have any cleanups for bike data?
 
-                try:
-                    # Sometimes, one of the positional data fields is null.
-                    # Thus, it is wise to check for NULL fields in our fields of interest, and all associations.
-                    if any(fields_x[i] == "NULL" for i in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]):
-                        # One of the positions is not set, so skip.
-                        continue
+        # Select the fields we are interested in.
+        # Note that we should remove ", which is present on every line.
+        fields_x = x.strip().replace("\"", "").split(",")
 
-                    # We don't want the trip duration to be 0.
-                    if fields_x[0] == 0:
-                        continue
+        # We are only interested in the fields 0, 1, 2, 5, 6, 9, 10 and 11.
+        target_fields = fields_x[11:12] + fields_x[1:3] + fields_x[6:7] + fields_x[5:6] + fields_x[10:11] + \
+                        fields_x[9:10] + fields_x[0:1]
 
-                    # Check the distance requirements.
-                    if is_valid_position(fields_x[6], fields_x[5]) \
-                            and is_valid_position(fields_x[10], fields_x[9]):
+        try:
+            # Sometimes, one of the positional data fields is null.
+            # Thus, it is wise to check for NULL fields in our fields of interest, and all associations.
+            if any(fields_x[i] == "NULL" for i in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]):
+                # One of the positions is not set, so skip.
+                continue
 
-                        # Add the entry to the pre-processing file.
-                        output_file.write('\n' + ",".join(target_fields))
-                except ValueError:
-                    print("Value error on line \"" + x.strip() + "\"")
+            # We don't want the trip duration to be 0.
+            if fields_x[0] == 0:
+                continue
 
+            # Check the distance requirements.
+            if cached_is_valid_position(fields_x[6], fields_x[5]) \
+                    and cached_is_valid_position(fields_x[10], fields_x[9]):
 
-if any(os.path.isfile(filename) for filename in bike_output_files):
-    answer = ""
-    while answer not in ["y", "n"]:
-        answer = input("Pre-processed bike files already exist. Are you sure you want to continue [Y/N]? ").lower()
-    if answer == "y":
+                # Add the entry to the pre-processing file.
+                output_file.write('\n' + ",".join(target_fields))
+                nr_accepted += 1
+                nr_rejected -= 1
+        except ValueError:
+            print("Value error on line \"" + x.strip() + "\"")
+
+    return nr_accepted, nr_rejected
+
+
+# Process the bike file in chunks of rows, and return the number of accepted and rejected rows.
+def pre_process_bike_chunks(data_file, output_file):
+    nr_accepted = 0
+    nr_lines = 0
+
+    while True:
+        lines = list(islice(data_file, chunk_size))
+        if len(lines) == 0:
+            break
+
+        columns, keep, faulty, positions = select_bike_rows(lines)
+        faulty_texts = process_faulty_lines(faulty, lambda i, text_file: pre_process_bike_lines([lines[i]], text_file))
+        nr_accepted += write_chunk(RowChunk(columns, keep, faulty, faulty_texts, positions), output_file)
+        nr_lines += len(lines)
+
+        if len(lines) < chunk_size:
+            break
+
+    return nr_accepted, nr_lines - nr_accepted
+
+
+# Apply all the filters to a chunk of bike lines.
+# Returns the valid lines in the output format as columns for join_fields, a mask of the valid lines, a mask of the
+# faulty lines and the positions of the valid lines.
+def select_bike_rows(lines):
+    buffer, starts, ends, faulty = split_lines(lines, 15, remove_quotes=True)
+
+    # Skip the entries with a NULL field in our fields of interest, and all associations.
+    # Note that the line loop compares the trip duration to the integer 0, which never holds, so there is no filter on
+    # the trip duration here either.
+    is_null = np.zeros(len(lines), dtype=bool)
+    for i in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]:
+        is_null |= fields_equal(buffer, starts[:, i], ends[:, i], b"NULL")
+    candidates = np.flatnonzero(~(faulty | is_null))
+    starts, ends = starts[candidates], ends[candidates]
+
+    # Check the distance requirements.
+    positions, faulty_positions = fields_to_floats(buffer, starts[:, [6, 5, 10, 9]].reshape(-1),
+                                                   ends[:, [6, 5, 10, 9]].reshape(-1))
+    positions = positions.reshape(-1, 4)
+    faulty_candidates = faulty_positions.reshape(-1, 4).any(axis=1)
+    valid = ~faulty_candidates & are_valid_positions(positions[:, 0], positions[:, 1]) \
+        & are_valid_positions(positions[:, 2], positions[:, 3])
+
+    keep = np.zeros(len(lines), dtype=bool)
+    keep[candidates[valid]] = True
+    faulty[candidates[faulty_candidates]] = True
+
+    # We are only interested in the fields 0, 1, 2, 5, 6, 9, 10 and 11.
+    starts, ends = starts[valid], ends[valid]
+    columns = [(buffer, starts[:, i], ends[:, i]) for i in [11, 1, 2, 6, 5, 10, 9, 0]]
+    return columns, keep, faulty, positions[valid]
+
+
+def process_files():
+    if any(os.path.isfile(intermediate_file(filename)) for filename in taxi_output_files):
+        answer = ""
+        while answer not in ["y", "n"]:
+            answer = input("Pre-processed taxi files already exist. Are you sure you want to continue [Y/N]? ").lower()
+        if answer == "y":
+            pre_process_taxi_files()
+    else:
+        pre_process_taxi_files()
+
+    if any(os.path.isfile(intermediate_file(filename)) for filename in bike_output_files):
+        answer = ""
+        while answer not in ["y", "n"]:
+            answer = input("Pre-processed bike files already exist. Are you sure you want to continue [Y/N]? ").lower()
+        if answer == "y":
+            pre_process_bike_files()
+    else:
         pre_process_bike_files()
-else:
-    pre_process_bike_files()
+
+
+# The worker processes import this module, so only start processing when the module is run as a script.
+if __name__ == "__main__":
+    process_files()
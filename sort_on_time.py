@@ -1,5 +1,13 @@
-import operator
-from datetime import datetime
+import heapq
+import io
+import sys
+import tempfile
+
+import numpy as np
+
+from chunked_csv import fields_to_times, needs_stripping
+from compressed_io import intermediate_file, open_input, open_output
+from time_codec import parse_time, parse_times
 
 
 # Next, we want to sort the clustered files on time, more specifically the starting time followed by end time.
@@ -21,83 +29,198 @@ bike_data_files = [bike_folder_location + "\\trip_data_" + str(i) + ".csv" for i
 bike_output_folder = "Z:\\data_engineering\\bike_sorted_trip_data"
 bike_output_files = [bike_output_folder + "\\trip_data_" + str(i) + ".csv" for i in range(6, 13)]
 
-# Format of a date time entry.
-time_format = '%Y-%m-%d %H:%M:%S'
+# The engine used to sort the files.
+#   - "arrays" loads the whole file into a single byte buffer, and finds the lines and their start times with array
+#     operations. The lines are sorted as offsets into the buffer, from which they are written in blocks.
+#   - "lines" loads the whole file as a list of lines, and sorts it at once.
+#   - "external" loads at most sort_memory_budget bytes of lines at a time, which are sorted and written to a temporary
+#     run file. The runs are merged into the output file afterwards.
+# All engines sort on the start time, keep entries with the same start time in their original order, and produce
+# exactly the same files.
+sort_engine = "arrays"
 
+# The number of lines of which the start times are converted, and which are written, at once by the arrays engine.
+sort_block_size = 100000
 
-def sort_taxi_file(_input, _output):
-    # First, import the entire file...
-    print("Setting clusters for", _input)
+# The number of bytes taken by the lines that are sorted at once by the external engine. While a run is sorted, the
+# start times and the order take about as much memory again.
+sort_memory_budget = 1 << 30
 
-    entries = []
+# The folder in which the runs of the external engine are stored, or None for the temporary folder of the system.
+# Preferably, this is a local disk rather than the network share.
+sort_run_folder = None
 
-    with open(_output, "w") as output_file:
-        with open(_input, "r") as input_file:
-            is_first = True
 
-            for line in input_file:
-                if is_first:
-                    is_first = False
-                    continue
-
-                # Select the fields we are interested in.
-                data_fields = line.strip().split(",")
-
-                entries += [
-                    (
-                        datetime.strptime(data_fields[1], time_format),
-                        datetime.strptime(data_fields[2], time_format),
-                        line
-                    )
-                ]
+def sort_taxi_file(_input, _output):
+    _input, _output = intermediate_file(_input), intermediate_file(_output)
 
-        # Write the header of the file.
-        output_file.write("taxi_id,start_time,end_time,from_cluster,to_cluster,passenger_count,"
-                          "trip_duration,fare_amount,tip_amount")
+    # First, import the entire file...
+    print("Setting clusters for", _input)
 
-        # Sort the entries, and output them.
-        entries.sort(key=lambda x: x[0])
+    with open_output(_output) as output_file:
+        with open_input(_input) as input_file:
+            # Skip the header.
+            next(input_file, None)
 
-        # Output all the entries.
-        for e in entries:
-            output_file.write('\n' + e[2].strip())
+            # Write the header of the file.
+            output_file.write("taxi_id,start_time,end_time,from_cluster,to_cluster,passenger_count,"
+                              "trip_duration,fare_amount,tip_amount,from_district,to_district")
+            sort_lines(input_file, output_file)
 
 
 def sort_bike_file(_input, _output):
+    _input, _output = intermediate_file(_input), intermediate_file(_output)
+
     # First, import the entire file...
     print("Setting clusters for", _input)
 
-    entries = []
-
-    with open(_output, "w") as output_file:
-        with open(_input, "r") as input_file:
-            is_first = True
-
-            for line in input_file:
-                if is_first:
-                    is_first = False
-                    continue
+    with open_output(_output) as output_file:
+        with open_input(_input) as input_file:
+            # Skip the header.
+            next(input_file, None)
 
-                # Select the fields we are interested in.
-                data_fields = line.strip().split(",")
+            # Write the header of the file.
+            output_file.write("bike_id,start_time,end_time,from_cluster,to_cluster,trip_duration,from_district,"
+                              "to_district")
+            sort_lines(input_file, output_file)
 
-                entries += [
-                    (
-                        datetime.strptime(data_fields[1], time_format),
-                        datetime.strptime(data_fields[2], time_format),
-                        line
-                    )
-                ]
 
-        # Write the header of the file.
-        output_file.write("bike_id,start_time,end_time,from_cluster,to_cluster,trip_duration")
-
-        # Sort the entries, and output them.
-        entries.sort(key=lambda x: x[0])
-
-        # Output all the entries.
-        for e in entries:
-            output_file.write('\n' + e[2].strip())
+# Sort the given lines on their start time with the chosen engine, and write them to the output file, each preceded by
+# a newline.
+def sort_lines(input_file, output_file):
+    if sort_engine == "arrays":
+        write_sorted_buffer(read_encoded(input_file), output_file)
+    elif sort_engine == "external":
+        write_externally_sorted_lines(input_file, output_file)
+    else:
+        write_sorted_lines(list(input_file), output_file)
+
+
+# Sort the given lines on their start time, and write them to the output file, each preceded by a newline.
+def write_sorted_lines(lines, output_file):
+    # Select the fields we are interested in.
+    start_times = [line.strip().split(",")[1] for line in lines]
+
+    # Convert the start times in one go, and sort the entries on them. Note that a stable sort is used.
+    order = np.argsort(parse_times(start_times), kind="stable")
+
+    # Output all the entries.
+    for i in order.tolist():
+        output_file.write('\n' + lines[i].strip())
+
+
+# Read the rest of the given text file, encoded as utf-8, in blocks such that the text is never held as a whole.
+def read_encoded(input_file):
+    data = bytearray()
+    for text in iter(lambda: input_file.read(sort_block_size * 128), ""):
+        data += text.encode("utf-8")
+    return data
+
+
+# Sort the lines of the given utf-8 encoded text on their start time, and write them to the output file, each preceded
+# by a newline. Only the encoded text, the start and end of every line and the order are held in memory, next to a
+# block of lines.
+def write_sorted_buffer(data, output_file):
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    # The lines end at the newlines, and at the end of the text if it does not end with a newline.
+    line_ends = np.flatnonzero(buffer == ord("\n"))
+    if len(buffer) > 0 and buffer[-1] != ord("\n"):
+        line_ends = np.append(line_ends, len(buffer))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1)).astype(np.int64)
+
+    # Find the start time of every line, which is the second field of the line.
+    start_times = np.zeros(len(line_ends), dtype=np.int64)
+    irregular_times = []
+    is_faulty = buffer.max(initial=0) >= 128
+    for block in range(0, len(line_ends), sort_block_size):
+        starts, ends = line_starts[block:block + sort_block_size], line_ends[block:block + sort_block_size]
+
+        # The separators of the block, followed by the end of the buffer, such that every line has a next separator.
+        separators = np.flatnonzero(buffer[starts[0]:ends[-1]] == ord(",")) + starts[0]
+        separators = np.append(separators, len(buffer))
+        first_separator = np.searchsorted(separators, starts)
+        field_starts = separators[first_separator] + 1
+        field_ends = np.minimum(separators[np.minimum(first_separator + 1, len(separators) - 1)], ends)
+
+        start_times[block:block + sort_block_size], is_irregular = fields_to_times(buffer, field_starts, field_ends)
+        irregular_times += [(block + i, field_starts[i], field_ends[i]) for i in np.flatnonzero(is_irregular).tolist()]
+        is_faulty = is_faulty or (field_starts > ends).any() or needs_stripping(buffer, starts, ends).any()
+
+    # If any of the lines is not stripped or does not have a start time, the file is left to the lines engine.
+    if is_faulty:
+        del buffer
+        write_sorted_lines(list(io.StringIO(data.decode("utf-8"))), output_file)
+        return
+
+    # The start times that are not in the fixed format are converted one by one.
+    for i, start, end in irregular_times:
+        start_times[i] = parse_time(buffer[start:end].tobytes().decode("utf-8"))
+
+    write_ordered_lines(buffer, line_starts, line_ends, np.argsort(start_times, kind="stable"), output_file)
+
+
+# Write the lines of the given utf-8 encoded buffer in the given order, each preceded by a newline, in blocks of lines
+# that are gathered from the buffer at once.
+def write_ordered_lines(buffer, line_starts, line_ends, order, output_file):
+    for block in range(0, len(order), sort_block_size):
+        starts = line_starts[order[block:block + sort_block_size]]
+        lengths = line_ends[order[block:block + sort_block_size]] - starts + 1
+
+        # Every line is preceded by a newline, which takes the place of the character before the line.
+        offsets = np.cumsum(lengths) - lengths
+        characters = buffer[np.repeat(starts - 1 - offsets, lengths) + np.arange(lengths.sum())]
+        characters[offsets] = ord("\n")
+        output_file.write(characters.tobytes().decode("utf-8"))
+
+
+# Sort the given lines in runs of at most sort_memory_budget bytes, and merge the runs into the output file.
+def write_externally_sorted_lines(lines, output_file):
+    run_files = []
+    try:
+        run = []
+        run_size = 0
+        for line in lines:
+            run.append(line)
+            run_size += sys.getsizeof(line)
+            if run_size >= sort_memory_budget:
+                run_files.append(write_run(run))
+                run = []
+                run_size = 0
+
+        # Everything fits in memory, so there is nothing to merge.
+        if len(run_files) == 0:
+            write_sorted_lines(run, output_file)
+            return
+
+        if len(run) > 0:
+            run_files.append(write_run(run))
+        del run
+
+        # Merge the runs on their start times. On equal start times, heapq.merge takes the line of the earliest run
+        # first, so the lines stay in their original order.
+        print("Merging", len(run_files), "sorted runs")
+        runs = [open(filename, "r", newline="\n") for filename in run_files]
+        try:
+            for run_file in runs:
+                # Skip the empty first line, as write_sorted_lines starts every line with a newline.
+                next(run_file, None)
+            for line in heapq.merge(*runs, key=lambda line: parse_time(line.split(",", 2)[1])):
+                output_file.write('\n' + line.strip())
+        finally:
+            for run_file in runs:
+                run_file.close()
+    finally:
+        for filename in run_files:
+            os.remove(filename)
+
+
+# Sort the given lines, and write them to a new temporary run file. Returns the name of the file.
+def write_run(lines):
+    handle, filename = tempfile.mkstemp(suffix=".csv", dir=sort_run_folder)
+    with open(handle, "w", newline="\n") as run_file:
+        write_sorted_lines(lines, run_file)
+    return filename
 
 
 def process_taxi_files():
@@ -111,7 +234,7 @@ def process_bike_files():
 
 
 def process_files():
-    if any(os.path.isfile(filename) for filename in taxi_output_files):
+    if any(os.path.isfile(intermediate_file(filename)) for filename in taxi_output_files):
         answer = ""
         while answer not in ["y", "n"]:
             answer = input("Sorted taxi files already exist. Are you sure you want to continue [Y/N]? ").lower()
@@ -120,7 +243,7 @@ def process_files():
     else:
         process_taxi_files()
 
-    if any(os.path.isfile(filename) for filename in bike_output_files):
+    if any(os.path.isfile(intermediate_file(filename)) for filename in bike_output_files):
         answer = ""
         while answer not in ["y", "n"]:
             answer = input("Sorted bike files already exist. Are you sure you want to continue [Y/N]? ").lower()
@@ -129,4 +252,7 @@ def process_files():
     else:
         process_bike_files()
 
-process_files()
+
+# The fused pipeline imports this module, so only process the files when the module is run as a script.
+if __name__ == "__main__":
+    process_files()
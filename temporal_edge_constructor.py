@@ -1,23 +1,37 @@
 import csv
 import datetime
+import heapq
 import json
 import queue as Q
 from collections import namedtuple
+from contextlib import ExitStack
+from itertools import islice
 
 import os
-from dateutil.parser import parse
 
+from compressed_io import intermediate_file, open_input, open_output
+from flat_tree import roll_up
+from time_codec import format_time, parse_time
 
-# The depth of the median tree, which is used to calculate the number of clusters.
+
+# The depth of the median tree with which the trips have been clustered.
 k = 10
-N = 2 ** k
+
+# The level of the tree at which the edges are constructed, which is at most k, and the number of clusters at that level.
+# The clusters of the trips are rolled up into the coarser clusters of this level, without clustering the trips again.
+cluster_level = k
+N = 2 ** cluster_level
 
 # The current threshold used to determine when temporal edges are active.
 # We need a minimum of 'threshold' edges active for an edge to be created:
 edge_threshold = 3
 
+# The thresholds for which the edges are constructed at once, or None to only construct the edges of edge_threshold.
+# All thresholds are handled in a single sweep over the trips, and the edges of each threshold are written to a file of
+# their own, e.g. edges_3.csv, which holds the same edges as a run with only that threshold.
+edge_thresholds = None
+
 # The location of the weather and the imported weather data.
-time_format = '%Y-%m-%d %H:%M:%S'
 weather_file_location = "Z:\\data_engineering\\weather_data\\weather.json"
 with open(weather_file_location, "r") as wf:
     weather = json.load(wf)
@@ -34,9 +48,9 @@ def make_code(date):
     return hour + day + month + year
 
 
-# parses a string of a time to a python datetime
+# parses a string of a time to epoch seconds
 def get_time(date_string):
-    return parse(date_string)
+    return parse_time(date_string)
 
 
 # Gets weather at a certain time.
@@ -54,8 +68,8 @@ def get_weather(time):
 # taxi_id,start_time,end_time,from_cluster,to_cluster,passenger_count,trip_duration,fare_amount,tip_amount
 # Get: from_cluster, to_cluster, passenger_count, trip_duration, tip_amount, trip_duration
 def get_data_from_taxi_row(row):
-    from_cluster = int(row[3])
-    to_cluster = int(row[4])
+    from_cluster = roll_up(int(row[3]), k, cluster_level)
+    to_cluster = roll_up(int(row[4]), k, cluster_level)
     passenger_count = int(row[5])
     trip_duration = int(row[6])
     fare_amount = float(row[7])
@@ -67,8 +81,8 @@ def get_data_from_taxi_row(row):
 # bike_id,start_time,end_time,from_cluster,to_cluster,trip_duration
 # Get: from_cluster, to_cluster, trip_duration
 def get_data_from_bike_row(row):
-    from_cluster = int(row[3])
-    to_cluster = int(row[4])
+    from_cluster = roll_up(int(row[3]), k, cluster_level)
+    to_cluster = roll_up(int(row[4]), k, cluster_level)
     trip_duration = int(row[5])
     return from_cluster, to_cluster, trip_duration
 
@@ -76,9 +90,9 @@ def get_data_from_bike_row(row):
 # Writes a row to the output file
 def write_taxi_row(start_time, end_time, from_cluster, to_cluster, avg_passenger_count, avg_trip_duration, 
                    avg_fare_amount, avg_tip_amount, count, writer):
-    start_time_str = start_time.strftime(time_format)
-    end_time_str = end_time.strftime(time_format)
-    duration = (end_time-start_time).total_seconds()
+    start_time_str = format_time(start_time)
+    end_time_str = format_time(end_time)
+    duration = float(end_time - start_time)
 
     global id_counter
     row = [id_counter, "Taxi", start_time_str, end_time_str, from_cluster, to_cluster, avg_passenger_count, 
@@ -93,9 +107,9 @@ def write_taxi_row(start_time, end_time, from_cluster, to_cluster, avg_passenger
 
 # Writes a bike row to the output file.
 def write_bike_row(start_time, end_time, from_cluster, to_cluster, avg_trip_duration, count, writer):
-    start_time_str = start_time.strftime(time_format)
-    end_time_str = end_time.strftime(time_format)
-    duration = (end_time-start_time).total_seconds()
+    start_time_str = format_time(start_time)
+    end_time_str = format_time(end_time)
+    duration = float(end_time - start_time)
 
     global id_counter
     row = [id_counter, "Bike", start_time_str, end_time_str, from_cluster, to_cluster, "", avg_trip_duration, "", ""]
@@ -109,7 +123,7 @@ def write_bike_row(start_time, end_time, from_cluster, to_cluster, avg_trip_dura
 
 # Location of the clustered taxi files.
 taxi_folder_location = "Z:\\data_engineering\\taxi_sorted_trip_data"
-taxi_data_files = [taxi_folder_location + "\\trip_data_" + str(i) + ".csv" for i in range(1, 13)][-1:]
+taxi_data_files = [taxi_folder_location + "\\trip_data_" + str(i) + ".csv" for i in range(1, 13)]
 
 # Location of the clustered taxi files.
 bike_folder_location = "Z:\\data_engineering\\bike_sorted_trip_data"
@@ -122,13 +136,81 @@ temporal_edges_file = "edges.csv"
 # The counter to generate unique ids.
 id_counter = 0
 
-
+# The counters of the ids of each threshold, when the edges of several thresholds are constructed at once.
+id_counters = {}
+
+# The engine used to sweep over the trips.
+#   - "heap" keeps the trips that are underway as (end time, row, pair, values) tuples in a heapq, in a sweep of its own
+#     for the taxi and for the bike edges, which handles all thresholds at once. The data of a trip is only parsed once,
+#     when it starts.
+#   - "queue" is the original loop, which keeps the whole rows of the trips in a queue.PriorityQueue.
+# Both engines produce exactly the same edges.
+sweep_engine = "heap"
+
+
+# Iterate over the rows of all the given files, which are each sorted on start time, as one stream that is sorted on
+# start time. Trips that start near the end of a month can be in the file of the next month, so the files are merged
+# rather than read one after the other. Rows with the same start time are taken from the earliest file first.
+# A file is only opened once the stream reaches the start time of its first row, so usually only the files of two
+# adjacent months are open at the same time. Yields the start time and the fields of every row.
+def iterate_sorted_rows(filenames):
+    filenames = [intermediate_file(filename) for filename in filenames]
+
+    # Find the start time of the first row of every file, without reading ahead.
+    pending = []
+    for i, filename in enumerate(filenames):
+        with open_input(filename, read_ahead=False) as input_file:
+            row = next(islice(csv.reader(input_file), 1, None), None)
+        if row is not None:
+            pending.append((get_time(row[1]), i))
+    pending.sort(reverse=True)
+
+    # A heap with the next row of every open file, as (start time, file index, row, reader).
+    heap = []
+    open_files = []
+    try:
+        while len(heap) > 0 or len(pending) > 0:
+            # Open the files of which the first row is not later than the next row of the open files.
+            while len(pending) > 0 and (len(heap) == 0 or pending[-1] <= heap[0][:2]):
+                i = pending.pop()[1]
+                print("[" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + "]", "Searching for temporal edges in",
+                      filenames[i])
+                input_file = open_input(filenames[i])
+                open_files.append(input_file)
+
+                # Create a reader for the csv file, and skip the header.
+                reader = csv.reader(input_file)
+                next(reader, None)
+                push_next_row(heap, i, reader)
+
+            start_time, i, row, reader = heapq.heappop(heap)
+            yield start_time, row
+            push_next_row(heap, i, reader)
+    finally:
+        for input_file in open_files:
+            input_file.close()
+
+
+# Push the next row of the reader of the file with the given index on the heap, if there is one.
+def push_next_row(heap, i, reader):
+    row = next(reader, None)
+    if row is not None:
+        heapq.heappush(heap, (get_time(row[1]), i, row, reader))
+
+
+# The edges are written to the given output file, or to the output files of a dict from thresholds to output files.
 def construct_taxi_temporal_edges(output_file):
+    if sweep_engine == "heap":
+        sweep_temporal_edges(taxi_data_files, get_data_from_taxi_row, write_taxi_row, False, output_file)
+        return
+    if isinstance(output_file, dict):
+        raise ValueError("The queue engine only constructs the edges of edge_threshold")
+
     # Pre-formatted trip tuple.
     Trip = namedtuple("Trip", "time data")
 
     # Matrices that hold the current time data for each cluster, plus supportive data.
-    time_matrix = [[[datetime.datetime.now(), datetime.datetime.now()] for _ in range(N)] for _ in range(N)]
+    time_matrix = [[[0, 0] for _ in range(N)] for _ in range(N)]
     taxi_matrix = [[[0, 0, 0, 0, 0] for _ in range(N)] for _ in range(N)]
     max_count_matrix = [[0 for _ in range(N)] for _ in range(N)]
 
@@ -139,92 +221,87 @@ def construct_taxi_temporal_edges(output_file):
     queue = Q.PriorityQueue()
     top_taxi = None
 
-    for filename in taxi_data_files:
-        with open(filename, "r") as input_file:
-            print("[" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + "]", "Searching for temporal edges in", filename)
-
-            # Create a reader for the csv file.
-            reader = csv.reader(input_file)
-
-            # Skip the header.
-            header = next(reader, None)
-
-            # Iterate over all the edges and update data as we go along.
-            for row in reader:
-                start_time = get_time(row[1])
-                end_time = get_time(row[2])
-                read_trip_start = Trip(start_time, row)
-                read_trip_end = Trip(end_time, row)
-
-                if top_taxi is not None:
-                    # Remove trips from the queue that have ended, with respect to the currently observed trip.
-                    while top_taxi.time < read_trip_start.time:
-                        from_cluster, to_cluster, passenger_count, trip_duration, fare_amount, tip_amount = \
-                            get_data_from_taxi_row(top_taxi.data)
-
-                        # If we are currently on our threshold, the current active temporal edge should end.
-                        # Thus, write the appropriate data to the file.
-                        if taxi_matrix[from_cluster][to_cluster][0] == edge_threshold:
-                            write_taxi_row(
-                                # The time at which the edge starts and ends.
-                                time_matrix[from_cluster][to_cluster][0],
-                                top_taxi.time,
-                                from_cluster,
-                                to_cluster,
-                                # The average taxi specific data.
-                                (taxi_matrix[from_cluster][to_cluster][1]/taxi_matrix[from_cluster][to_cluster][0]),
-                                (taxi_matrix[from_cluster][to_cluster][2]/taxi_matrix[from_cluster][to_cluster][0]),
-                                (taxi_matrix[from_cluster][to_cluster][3]/taxi_matrix[from_cluster][to_cluster][0]),
-                                (taxi_matrix[from_cluster][to_cluster][4]/taxi_matrix[from_cluster][to_cluster][0]),
-                                max_count_matrix[from_cluster][to_cluster],
-                                writer
-                            )
-
-                        # Update the number of active edges and total duration.
-                        taxi_matrix[from_cluster][to_cluster][0] -= 1  # Update count
-                        taxi_matrix[from_cluster][to_cluster][1] -= passenger_count  # Update duration
-                        taxi_matrix[from_cluster][to_cluster][2] -= trip_duration  # Update fare
-                        taxi_matrix[from_cluster][to_cluster][3] -= fare_amount  # Update tip
-                        taxi_matrix[from_cluster][to_cluster][4] -= tip_amount  # Update passenger
-
-                        if queue.empty():
-                            top_taxi = None
-                            break
-                        else:
-                            top_taxi = queue.get()
-
-                # Add the new line to the database.
-                from_cluster, to_cluster, passenger_count, trip_duration, fare_amount, tip_amount = \
-                    get_data_from_taxi_row(row)
+    # Iterate over the trips of all files in the order of their start time, and update data as we go along.
+    for start_time, row in iterate_sorted_rows(taxi_data_files):
+        end_time = get_time(row[2])
+        read_trip_start = Trip(start_time, row)
+        read_trip_end = Trip(end_time, row)
 
-                # If we reach the threshold by adding this edge, register the start time of the temporal edge.
-                if taxi_matrix[from_cluster][to_cluster][0] == edge_threshold - 1:
-                    # Add starting time
-                    time_matrix[from_cluster][to_cluster][0] = read_trip_start.time
+        if top_taxi is not None:
+            # Remove trips from the queue that have ended, with respect to the currently observed trip.
+            while top_taxi.time < read_trip_start.time:
+                from_cluster, to_cluster, passenger_count, trip_duration, fare_amount, tip_amount = \
+                    get_data_from_taxi_row(top_taxi.data)
+
+                # If we are currently on our threshold, the current active temporal edge should end.
+                # Thus, write the appropriate data to the file.
+                if taxi_matrix[from_cluster][to_cluster][0] == edge_threshold:
+                    write_taxi_row(
+                        # The time at which the edge starts and ends.
+                        time_matrix[from_cluster][to_cluster][0],
+                        top_taxi.time,
+                        from_cluster,
+                        to_cluster,
+                        # The average taxi specific data.
+                        (taxi_matrix[from_cluster][to_cluster][1]/taxi_matrix[from_cluster][to_cluster][0]),
+                        (taxi_matrix[from_cluster][to_cluster][2]/taxi_matrix[from_cluster][to_cluster][0]),
+                        (taxi_matrix[from_cluster][to_cluster][3]/taxi_matrix[from_cluster][to_cluster][0]),
+                        (taxi_matrix[from_cluster][to_cluster][4]/taxi_matrix[from_cluster][to_cluster][0]),
+                        max_count_matrix[from_cluster][to_cluster],
+                        writer
+                    )
 
                 # Update the number of active edges and total duration.
-                taxi_matrix[from_cluster][to_cluster][0] += 1  # Update count
-                taxi_matrix[from_cluster][to_cluster][1] += passenger_count  # Update duration
-                taxi_matrix[from_cluster][to_cluster][2] += trip_duration  # Update fare
-                taxi_matrix[from_cluster][to_cluster][3] += fare_amount  # Update tip
-                taxi_matrix[from_cluster][to_cluster][4] += tip_amount  # Update passenger
+                taxi_matrix[from_cluster][to_cluster][0] -= 1  # Update count
+                taxi_matrix[from_cluster][to_cluster][1] -= passenger_count  # Update duration
+                taxi_matrix[from_cluster][to_cluster][2] -= trip_duration  # Update fare
+                taxi_matrix[from_cluster][to_cluster][3] -= fare_amount  # Update tip
+                taxi_matrix[from_cluster][to_cluster][4] -= tip_amount  # Update passenger
+
+                if queue.empty():
+                    top_taxi = None
+                    break
+                else:
+                    top_taxi = queue.get()
 
-                if max_count_matrix[from_cluster][to_cluster] < taxi_matrix[from_cluster][to_cluster][0]:
-                    max_count_matrix[from_cluster][to_cluster] = taxi_matrix[from_cluster][to_cluster][0]
+        # Add the new line to the database.
+        from_cluster, to_cluster, passenger_count, trip_duration, fare_amount, tip_amount = \
+            get_data_from_taxi_row(row)
 
-                queue.put(read_trip_end)
+        # If we reach the threshold by adding this edge, register the start time of the temporal edge.
+        if taxi_matrix[from_cluster][to_cluster][0] == edge_threshold - 1:
+            # Add starting time
+            time_matrix[from_cluster][to_cluster][0] = read_trip_start.time
 
-                # If we have no top, pop the queue.
-                if top_taxi is None:
-                    top_taxi = queue.get()
+        # Update the number of active edges and total duration.
+        taxi_matrix[from_cluster][to_cluster][0] += 1  # Update count
+        taxi_matrix[from_cluster][to_cluster][1] += passenger_count  # Update duration
+        taxi_matrix[from_cluster][to_cluster][2] += trip_duration  # Update fare
+        taxi_matrix[from_cluster][to_cluster][3] += fare_amount  # Update tip
+        taxi_matrix[from_cluster][to_cluster][4] += tip_amount  # Update passenger
+
+        if max_count_matrix[from_cluster][to_cluster] < taxi_matrix[from_cluster][to_cluster][0]:
+            max_count_matrix[from_cluster][to_cluster] = taxi_matrix[from_cluster][to_cluster][0]
+
+        queue.put(read_trip_end)
+
+        # If we have no top, pop the queue.
+        if top_taxi is None:
+            top_taxi = queue.get()
 
 
 def construct_bike_temporal_edges(output_file):
+    if sweep_engine == "heap":
+        sweep_temporal_edges(bike_data_files, get_data_from_bike_row, write_bike_row, True, output_file)
+        return
+    if isinstance(output_file, dict):
+        raise ValueError("The queue engine only constructs the edges of edge_threshold")
+
     # Pre-formatted trip tuple.
     Trip = namedtuple("Trip", "time data")
 
     # Matrices that hold the current time data for each cluster, plus supportive data.
-    time_matrix = [[[datetime.datetime.now(), datetime.datetime.now()] for _ in range(N)] for _ in range(N)]
+    time_matrix = [[[0, 0] for _ in range(N)] for _ in range(N)]
     bike_matrix = [[[0, 0] for _ in range(N)] for _ in range(N)]
     max_count_matrix = [[0 for _ in range(N)] for _ in range(N)]
 
@@ -235,91 +312,217 @@ def construct_bike_temporal_edges(output_file):
     queue = Q.PriorityQueue()
     top_bike = None
 
-    for filename in bike_data_files:
-        with open(filename, "r") as input_file:
-            print("[" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + "]", "Searching for temporal edges in", filename)
-
-            # Create a reader for the csv file.
-            reader = csv.reader(input_file)
-
-            # Skip the header.
-            header = next(reader, None)
-
-            # Iterate over all the edges and update data as we go along.
-            for row in reader:
-                start_time = get_time(row[1])
-                end_time = get_time(row[2])
-                read_trip_start = Trip(start_time, row)
-                read_trip_end = Trip(end_time, row)
-
-                if top_bike is not None:
-                    # Remove trips from the queue that have ended, with respect to the currently observed trip.
-                    while top_bike.time < read_trip_start.time:
-                        from_cluster, to_cluster, trip_duration = get_data_from_bike_row(top_bike.data)
-
-                        # If we are currently on our threshold, the current active temporal edge should end.
-                        # Thus, write the appropriate data to the file.
-                        if bike_matrix[from_cluster][to_cluster][0] == edge_threshold:
-                            write_bike_row(
-                                # The time at which the edge starts and ends.
-                                time_matrix[from_cluster][to_cluster][0],
-                                top_bike.time,
-                                from_cluster,
-                                to_cluster,
-                                # The average distance traveled by the bikes during the trips.
-                                (bike_matrix[from_cluster][to_cluster][1]/bike_matrix[from_cluster][to_cluster][0]),
-                                max_count_matrix[from_cluster][to_cluster],
-                                writer
-                            )
-                            max_count_matrix[from_cluster][to_cluster] = edge_threshold
-
-                        # Update the number of active edges and total duration.
-                        bike_matrix[from_cluster][to_cluster][0] -= 1
-                        bike_matrix[from_cluster][to_cluster][1] -= trip_duration
-
-                        if queue.empty():
-                            top_bike = None
-                            break
-                        else:
-                            top_bike = queue.get()
-
-                # Add the new line to the database.
-                from_cluster, to_cluster, trip_duration = get_data_from_bike_row(row)
-
-                # If we reach the threshold by adding this edge, register the start time of the temporal edge.
-                if bike_matrix[from_cluster][to_cluster][0] == edge_threshold - 1:
-                    # Add starting time
-                    time_matrix[from_cluster][to_cluster][0] = read_trip_start.time
+    # Iterate over the trips of all files in the order of their start time, and update data as we go along.
+    for start_time, row in iterate_sorted_rows(bike_data_files):
+        end_time = get_time(row[2])
+        read_trip_start = Trip(start_time, row)
+        read_trip_end = Trip(end_time, row)
+
+        if top_bike is not None:
+            # Remove trips from the queue that have ended, with respect to the currently observed trip.
+            while top_bike.time < read_trip_start.time:
+                from_cluster, to_cluster, trip_duration = get_data_from_bike_row(top_bike.data)
+
+                # If we are currently on our threshold, the current active temporal edge should end.
+                # Thus, write the appropriate data to the file.
+                if bike_matrix[from_cluster][to_cluster][0] == edge_threshold:
+                    write_bike_row(
+                        # The time at which the edge starts and ends.
+                        time_matrix[from_cluster][to_cluster][0],
+                        top_bike.time,
+                        from_cluster,
+                        to_cluster,
+                        # The average distance traveled by the bikes during the trips.
+                        (bike_matrix[from_cluster][to_cluster][1]/bike_matrix[from_cluster][to_cluster][0]),
+                        max_count_matrix[from_cluster][to_cluster],
+                        writer
+                    )
+                    max_count_matrix[from_cluster][to_cluster] = edge_threshold
 
                 # Update the number of active edges and total duration.
-                bike_matrix[from_cluster][to_cluster][0] += 1
-                bike_matrix[from_cluster][to_cluster][1] += trip_duration
-
-                if max_count_matrix[from_cluster][to_cluster] < bike_matrix[from_cluster][to_cluster][0]:
-                    max_count_matrix[from_cluster][to_cluster] = bike_matrix[from_cluster][to_cluster][0]
+                bike_matrix[from_cluster][to_cluster][0] -= 1
+                bike_matrix[from_cluster][to_cluster][1] -= trip_duration
 
-                queue.put(read_trip_end)
-
-                # If we have no top, pop the queue.
-                if top_bike is None:
+                if queue.empty():
+                    top_bike = None
+                    break
+                else:
                     top_bike = queue.get()
 
+        # Add the new line to the database.
+        from_cluster, to_cluster, trip_duration = get_data_from_bike_row(row)
+
+        # If we reach the threshold by adding this edge, register the start time of the temporal edge.
+        if bike_matrix[from_cluster][to_cluster][0] == edge_threshold - 1:
+            # Add starting time
+            time_matrix[from_cluster][to_cluster][0] = read_trip_start.time
+
+        # Update the number of active edges and total duration.
+        bike_matrix[from_cluster][to_cluster][0] += 1
+        bike_matrix[from_cluster][to_cluster][1] += trip_duration
+
+        if max_count_matrix[from_cluster][to_cluster] < bike_matrix[from_cluster][to_cluster][0]:
+            max_count_matrix[from_cluster][to_cluster] = bike_matrix[from_cluster][to_cluster][0]
+
+        queue.put(read_trip_end)
+
+        # If we have no top, pop the queue.
+        if top_bike is None:
+            top_bike = queue.get()
+
+
+# Sweep over the trips of the given files in the order of their start time, and write a temporal edge whenever the
+# number of trips that are underway between two clusters drops below the threshold. The data of a row is read with the
+# given function, which returns the clusters followed by the values that are averaged over the trips of an edge. The
+# edges are written with the given function, which takes the same arguments as write_taxi_row and write_bike_row. The
+# bike edges reset the maximum count of their pair after an edge is written, and the taxi edges do not.
+#
+# The edges are written to the given output file for edge_threshold, or for each threshold in a dict from thresholds to
+# output files to the file of that threshold. As the number of trips of a pair changes by one at a time, it crosses at
+# most one threshold at every step, so the thresholds only share the counts and sums of the sweep. The edges of every
+# threshold get ids of their own from id_counters.
+#
+# This follows the original loops. Like the top_taxi and top_bike of those loops, the trip that ends first is taken out
+# of the heap and held on to, until the trip that is read next starts after it has ended. Trips that end at the same
+# time are taken from the heap in the order of their rows, which the queue compared as lists of fields. The fields are
+# kept as a tuple, which compares in the same way, and which holds the strings of the row without copying them.
+def sweep_temporal_edges(filenames, get_data, write_row, reset_max_count, output_file):
+    outputs = output_file if isinstance(output_file, dict) else {edge_threshold: output_file}
+    thresholds = sorted(outputs)
+    threshold_indices = {threshold: i for i, threshold in enumerate(thresholds)}
+    nr_thresholds = len(thresholds)
+
+    # Create a writer for every threshold.
+    writers = [csv.writer(outputs[threshold]) for threshold in thresholds]
+
+    # Write an edge of the threshold with the given index, with the ids of that threshold if there are several.
+    def write_edge(i, *arguments):
+        global id_counter
+        if not isinstance(output_file, dict):
+            write_row(*arguments, writers[i])
+            return
+
+        previous_id_counter = id_counter
+        id_counter = id_counters.get(thresholds[i], 0)
+        write_row(*arguments, writers[i])
+        id_counters[thresholds[i]] = id_counter
+        id_counter = previous_id_counter
+
+    # The state of the pairs of clusters with trips underway, by from_cluster * N + to_cluster. Every state is a list of
+    #   0 - the number of trips that are underway
+    #   1 - the start time of the current temporal edge of each threshold
+    #   1 + T - the maximum number of trips that were underway for each threshold
+    #   1 + 2T - the sums of the values of the trips that are underway, one entry for each value
+    # where T is the number of thresholds.
+    # The state of a pair is removed once its last trip has ended, so the memory scales with the number of pairs that
+    # have had trips rather than with N * N. The maximum count of a taxi pair is never reset, and is the same for all
+    # thresholds, so it is kept as a single number for every pair that has had trips. The sums of the fares and tips
+    # rarely return to exactly zero due to rounding, and the original loops keep subtracting from what is left, so the
+    # sums that are left are kept as well, such that the next averages of the pair stay the same.
+    states = {}
+    max_counts = {}
+    residues = {}
+    sums_start = 1 + 2 * nr_thresholds
+
+    heap = []
+    top = None
+
+    for start_time, row in iterate_sorted_rows(filenames):
+        end_time = get_time(row[2])
+
+        # Remove trips from the heap that have ended, with respect to the currently observed trip.
+        while top is not None and top[0] < start_time:
+            top_end_time, _, pair, values = top
+            state = states[pair]
+            count = state[0]
+
+            # If we are currently on a threshold, the current active temporal edge of that threshold should end.
+            i = threshold_indices.get(count)
+            if i is not None:
+                averages = [total / count for total in state[sums_start:]]
+                write_edge(i, state[1 + i], top_end_time, pair // N, pair % N, *averages, state[1 + nr_thresholds + i])
+                if reset_max_count:
+                    state[1 + nr_thresholds + i] = count
+
+            # Update the number of active trips and the sums of their values.
+            state[0] = count - 1
+            for j, value in enumerate(values):
+                state[sums_start + j] -= value
+
+            if count == 1:
+                # A bike pair only writes an edge after its count has reached the threshold, so its maximum count from
+                # before does not matter when its count starts from zero again.
+                if not reset_max_count:
+                    max_counts[pair] = state[1 + nr_thresholds]
+                if any(state[sums_start:]):
+                    residues[pair] = state[sums_start:]
+                del states[pair]
+
+            top = heapq.heappop(heap) if len(heap) > 0 else None
+
+        # Add the new trip.
+        data = get_data(row)
+        pair = data[0] * N + data[1]
+        values = data[2:]
+        state = states.get(pair)
+        if state is None:
+            state = [0] * (1 + nr_thresholds) + [max_counts.get(pair, 0)] * nr_thresholds + \
+                residues.pop(pair, [0] * len(values))
+            states[pair] = state
+
+        # If we reach a threshold by adding this trip, register the start time of its temporal edge.
+        count = state[0] + 1
+        i = threshold_indices.get(count)
+        if i is not None:
+            state[1 + i] = start_time
+
+        state[0] = count
+        for j, value in enumerate(values):
+            state[sums_start + j] += value
+
+        for j in range(1 + nr_thresholds, sums_start):
+            if state[j] < count:
+                state[j] = count
+
+        heapq.heappush(heap, (end_time, tuple(row), pair, values))
+
+        # If we have no top, pop the heap.
+        if top is None:
+            top = heapq.heappop(heap)
+
+
+# The files to which the edges are written: the temporal edges file for edge_threshold, or a file for every threshold.
+def temporal_edges_files():
+    if edge_thresholds is None:
+        return {edge_threshold: temporal_graph_folder + "\\" + temporal_edges_file}
+
+    name, extension = os.path.splitext(temporal_edges_file)
+    return {threshold: temporal_graph_folder + "\\" + name + "_" + str(threshold) + extension
+            for threshold in edge_thresholds}
 
-def _construct_temporal_edges():
-    # Open a writer to the result file.
-    with open(temporal_graph_folder + "\\" + temporal_edges_file, "w", newline='') as output_file:
-        # Write the header.
-        writer = csv.writer(output_file)
-        writer.writerow(["edge_id", "edge_label", "start_time", "end_time", "from_cluster", "to_cluster",
-                         "passenger_count", "trip_duration", "fare_amount", "tip_amount", "temperature", "fog",
-                         "rain", "condition", "no_of_edges", "duration"])
 
+def _construct_temporal_edges():
+    # Open a writer to the result file of every threshold.
+    with ExitStack() as stack:
+        output_files = {}
+        for threshold, filename in temporal_edges_files().items():
+            output_files[threshold] = stack.enter_context(open_output(filename, newline=''))
+
+            # Write the header.
+            writer = csv.writer(output_files[threshold])
+            writer.writerow(["edge_id", "edge_label", "start_time", "end_time", "from_cluster", "to_cluster",
+                             "passenger_count", "trip_duration", "fare_amount", "tip_amount", "temperature", "fog",
+                             "rain", "condition", "no_of_edges", "duration"])
+
+        output_file = output_files if edge_thresholds is not None else output_files[edge_threshold]
         construct_taxi_temporal_edges(output_file)
+
+        # The bike edges are not constructed for now, so the bike files are only merged once this is enabled again.
         # construct_bike_temporal_edges(output_file)
 
 
 def construct_temporal_edges():
-    if os.path.isfile(temporal_graph_folder + "\\" + temporal_edges_file):
+    if any(os.path.isfile(filename) for filename in temporal_edges_files().values()):
         answer = ""
         while answer not in ["y", "n"]:
             answer = input("Temporal edges file already exists. Are you sure you want to continue [Y/N]? ").lower()
@@ -1,11 +1,15 @@
 import csv
-import json
-from collections import namedtuple
-import fiona
 import os
+from itertools import islice
 
-from shapely.geometry import Point, shape
-from dbfread import DBF
+import numpy as np
+
+from chunked_csv import fields_to_ints, fields_to_times, split_lines
+from compressed_io import intermediate_file, open_input, open_output
+from find_neighborhood import add_neighborhoods
+from flat_tree import FlatTree, as_flat_tree, load_leaf_counts, load_median_tree, roll_up
+from time_codec import parse_time
+from worker_pool import process_in_parallel
 
 # We start with constructing the nodes file.
 # Import the desired cluster tree.
@@ -13,9 +17,9 @@ k = 10
 median_cluster_tree_folder = "Z:\\data_engineering"
 median_cluster_tree_file = "median_cluster_tree_k_" + str(k) + ".json"
 
-with open(median_cluster_tree_folder + "\\" + median_cluster_tree_file, 'r') as median_tree_file:
-    data = median_tree_file.read()
-median_tree = json.loads(data, object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+# The level of the tree at which the nodes are taken, which is at most k.
+# The trips are clustered once with the tree of depth k, and are rolled up into the coarser clusters of a lower level.
+cluster_level = k
 
 
 # Convert the median tree to the list of nodes.
@@ -38,11 +42,24 @@ class TGNode:
         self.nr_taxi_ends = 0
         self.nr_bike_ends = 0
 
+        # The same counts per hour of the day, followed by the count of the trips of which the time is not valid.
+        self.nr_taxi_starts_per_hour = [0] * 25
+        self.nr_bike_starts_per_hour = [0] * 25
+        self.nr_taxi_ends_per_hour = [0] * 25
+        self.nr_bike_ends_per_hour = [0] * 25
+
 
-def get_all_nodes(tree, _nodes=None):
+def get_all_nodes(tree, _nodes=None, level=None, leaf_counts=None):
     if _nodes is None:
         _nodes = []
 
+    # The flat tree has the leaves readily available, and can roll them up to a coarser level, weighting the centers of
+    # the leaves by the given number of positions in each of them.
+    if level is not None or isinstance(tree, FlatTree):
+        leaves = as_flat_tree(tree).get_leaves(level, leaf_counts)
+        _nodes += [TGNode(_id, float(center[0]), float(center[1])) for _id, center in leaves]
+        return
+
     # If we have children, pass the command down.
     if tree.lesser_child is not None:
         get_all_nodes(tree.lesser_child, _nodes)
@@ -53,20 +70,25 @@ def get_all_nodes(tree, _nodes=None):
 
 
 # We know that the ids are given in incremental order, starting by 0.
+# The nodes are only constructed when the module is run as a script, as the workers that count the trips import it.
 nodes = []
-get_all_nodes(median_tree, nodes)
 
 # Find the district the cluster is part of, by checking which district the center point is in.
 neighborhood_data_folder = "Z:\\data_engineering\\neighborhood_data"
 
-with fiona.open(neighborhood_data_folder + "\\neighbourhoods.shp") as f:
-    db = DBF(neighborhood_data_folder + "\\neighbourhoods.dbf")
 
-    for multi, record in zip(f, db):
-        for i, node in enumerate(nodes):
-            point = Point(node.lon, node.lat)
-            if point.within(shape(multi['geometry'])):
-                nodes[i].district = record["Name"]
+# The tree is only loaded here, as the workers that count the trips import this module, and do not need it.
+def construct_nodes():
+    median_tree = load_median_tree(median_cluster_tree_folder + "\\" + median_cluster_tree_file)
+    leaf_counts = None
+    if cluster_level < k:
+        leaf_counts = load_leaf_counts(median_cluster_tree_folder + "\\" + median_cluster_tree_file)
+        if leaf_counts is None:
+            print("There are no leaf summaries of the tree, so the leaves are weighted equally in the coarser clusters.")
+    get_all_nodes(median_tree, nodes, cluster_level if cluster_level < k else None, leaf_counts)
+    add_neighborhoods(nodes, neighborhood_data_folder + "\\neighbourhoods.shp",
+                      neighborhood_data_folder + "\\neighbourhoods.dbf")
+
 
 # Location of the clustered taxi files.
 taxi_folder_location = "Z:\\data_engineering\\taxi_clustered_trip_data"
@@ -77,9 +99,18 @@ bike_folder_location = "Z:\\data_engineering\\bike_clustered_trip_data"
 bike_data_files = [bike_folder_location + "\\trip_data_" + str(i) + ".csv" for i in range(6, 13)]
 
 
+# Get the hour of the day of the given time, or 24 if it is not a valid time. The trips with such a time are only
+# counted in the totals of the nodes, as they were before the trips were counted per hour.
+def hour_of_day(time_string):
+    try:
+        return parse_time(time_string) // 3600 % 24
+    except ValueError:
+        return 24
+
+
 # For each of the data files, replace the position with the appropriate cluster id.
 def process_taxi_file(_input):
-    with open(_input, "r") as input_file:
+    with open_input(intermediate_file(_input)) as input_file:
         is_first = True
 
         for line in input_file:
@@ -90,15 +121,17 @@ def process_taxi_file(_input):
             # Select the fields we are interested in.
             data_fields = line.strip().split(",")
 
-            from_cluster = int(data_fields[3])
-            to_cluster = int(data_fields[4])
+            from_cluster = roll_up(int(data_fields[3]), k, cluster_level)
+            to_cluster = roll_up(int(data_fields[4]), k, cluster_level)
 
             nodes[from_cluster].nr_taxi_starts += 1
             nodes[to_cluster].nr_taxi_ends += 1
+            nodes[from_cluster].nr_taxi_starts_per_hour[hour_of_day(data_fields[1])] += 1
+            nodes[to_cluster].nr_taxi_ends_per_hour[hour_of_day(data_fields[2])] += 1
 
 
 def process_bike_file(_input):
-    with open(_input, "r") as input_file:
+    with open_input(intermediate_file(_input)) as input_file:
         is_first = True
 
         for line in input_file:
@@ -109,27 +142,109 @@ def process_bike_file(_input):
             # Select the fields we are interested in.
             data_fields = line.strip().split(",")
 
-            from_cluster = int(data_fields[3])
-            to_cluster = int(data_fields[4])
+            from_cluster = roll_up(int(data_fields[3]), k, cluster_level)
+            to_cluster = roll_up(int(data_fields[4]), k, cluster_level)
 
             nodes[from_cluster].nr_bike_starts += 1
             nodes[to_cluster].nr_bike_ends += 1
+            nodes[from_cluster].nr_bike_starts_per_hour[hour_of_day(data_fields[1])] += 1
+            nodes[to_cluster].nr_bike_ends_per_hour[hour_of_day(data_fields[2])] += 1
+
+
+# The engine used to count the trips that start and end at each node.
+#   - "arrays" reads the cluster and time columns of chunks of rows at once, and counts them per node and hour with
+#     bincount. The files are counted in parallel by the workers of worker_pool, after which the counts are added.
+#   - "lines" handles the rows one by one, and counts the trips on the nodes themselves.
+# Both engines produce exactly the same files.
+node_statistics_engine = "arrays"
+
+# The number of rows the arrays engine loads at once.
+chunk_size = 100000
+
+
+# Count the trips in the given clustered file, of which the rows have the given number of fields.
+# Returns an array of (2 x nodes x 25) counts, holding the trips that start and the trips that end at each node in each
+# hour of the day, followed by those of which the time is not valid.
+def count_trips(_input, nr_fields):
+    _input = intermediate_file(_input)
+    print("Counting trips in", _input)
+
+    nr_nodes = 2 ** cluster_level
+    counts = np.zeros(2 * nr_nodes * 25, dtype=np.int64)
+    with open_input(_input) as input_file:
+        # Skip the header.
+        next(input_file, None)
+
+        while True:
+            lines = list(islice(input_file, chunk_size))
+            if len(lines) == 0:
+                break
+
+            # The times are the second and third field, and the clusters the fourth and fifth field.
+            buffer, starts, ends, faulty = split_lines(lines, nr_fields)
+            clusters, faulty_clusters = fields_to_ints(buffer, starts[:, 3:5].reshape(-1), ends[:, 3:5].reshape(-1))
+            times, faulty_times = fields_to_times(buffer, starts[:, 1:3].reshape(-1), ends[:, 1:3].reshape(-1))
+            faulty |= faulty_clusters.reshape(-1, 2).any(axis=1) | faulty_times.reshape(-1, 2).any(axis=1)
+
+            # Index the counts as (start or end, node, hour).
+            keep = ~faulty
+            clusters = roll_up(clusters.reshape(-1, 2)[keep], k, cluster_level)
+            if (clusters >= nr_nodes).any():
+                raise IndexError("Cluster id " + str(clusters.max()) + " out of range in " + _input)
+            indices = (np.arange(2) * nr_nodes + clusters) * 25 + times.reshape(-1, 2)[keep] // 3600 % 24
+            counts += np.bincount(indices.reshape(-1), minlength=len(counts))
+
+            # The rows that cannot be handled as a whole are split and parsed as in the line loop.
+            for i in np.flatnonzero(faulty).tolist():
+                data_fields = lines[i].strip().split(",")
+                for j in range(0, 2):
+                    cluster = roll_up(int(data_fields[3 + j]), k, cluster_level)
+                    counts.reshape(2, -1, 25)[j, cluster, hour_of_day(data_fields[1 + j])] += 1
+    return counts.reshape(2, -1, 25)
+
+
+def count_taxi_trips(_input):
+    return count_trips(_input, 11)
+
+
+def count_bike_trips(_input):
+    return count_trips(_input, 8)
+
+
+# Add the counts of the given files to the nodes, as the trips of the given kind.
+def add_trip_counts(counts, kind):
+    counts = sum(counts)
+    for node in nodes:
+        starts_per_hour = counts[0, node.node_id].tolist()
+        ends_per_hour = counts[1, node.node_id].tolist()
+        setattr(node, "nr_" + kind + "_starts", getattr(node, "nr_" + kind + "_starts") + sum(starts_per_hour))
+        setattr(node, "nr_" + kind + "_ends", getattr(node, "nr_" + kind + "_ends") + sum(ends_per_hour))
+        for hour in range(0, 25):
+            getattr(node, "nr_" + kind + "_starts_per_hour")[hour] += starts_per_hour[hour]
+            getattr(node, "nr_" + kind + "_ends_per_hour")[hour] += ends_per_hour[hour]
 
 
 # The location where the node file is located.
 temporal_graph_folder = "Z:\\data_engineering\\temporal_graph"
 temporal_nodes_file = "nodes.csv"
 
+# The file with the number of trips that start and end at each node in each hour of the day, or None to skip it.
+temporal_node_hours_file = "node_hours.csv"
+
 
 def _process_files():
-    for i in range(0, len(taxi_data_files)):
-        process_taxi_file(taxi_data_files[i])
+    if node_statistics_engine == "arrays":
+        add_trip_counts(process_in_parallel(count_taxi_trips, taxi_data_files), "taxi")
+        add_trip_counts(process_in_parallel(count_bike_trips, bike_data_files), "bike")
+    else:
+        for i in range(0, len(taxi_data_files)):
+            process_taxi_file(taxi_data_files[i])
 
-    for i in range(0, len(bike_data_files)):
-        process_bike_file(bike_data_files[i])
+        for i in range(0, len(bike_data_files)):
+            process_bike_file(bike_data_files[i])
 
     # TODO output files to csv.
-    with open(temporal_graph_folder + "\\" + temporal_nodes_file, "w", newline='') as output_file:
+    with open_output(temporal_graph_folder + "\\" + temporal_nodes_file, newline='') as output_file:
         writer = csv.writer(output_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         writer.writerow(["node_id", "lon", "lat", "district", "nr_taxi_starts", "nr_bike_starts", "nr_taxi_ends",
                          "nr_bike_ends"])
@@ -138,6 +253,19 @@ def _process_files():
             writer.writerow([node.node_id, node.lon, node.lat, node.district, node.nr_taxi_starts, node.nr_bike_starts,
                              node.nr_taxi_ends, node.nr_bike_ends])
 
+    if temporal_node_hours_file is None:
+        return
+
+    with open_output(temporal_graph_folder + "\\" + temporal_node_hours_file, newline='') as output_file:
+        writer = csv.writer(output_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["node_id", "hour", "nr_taxi_starts", "nr_bike_starts", "nr_taxi_ends", "nr_bike_ends"])
+
+        for node in nodes:
+            for hour in range(0, 24):
+                writer.writerow([node.node_id, hour, node.nr_taxi_starts_per_hour[hour],
+                                 node.nr_bike_starts_per_hour[hour], node.nr_taxi_ends_per_hour[hour],
+                                 node.nr_bike_ends_per_hour[hour]])
+
 
 def process_files():
     if os.path.isfile(temporal_graph_folder + "\\" + temporal_nodes_file):
@@ -150,6 +278,9 @@ def process_files():
         _process_files()
 
 
-process_files()
+# The workers of the arrays engine import this module, so only construct the nodes when the module is run as a script.
+if __name__ == "__main__":
+    construct_nodes()
+    process_files()
 
 
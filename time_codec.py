@@ -0,0 +1,127 @@
+import calendar
+import re
+from datetime import date, datetime
+
+import numpy as np
+
+# All the stages of the pipeline store times in the same fixed format, e.g. "2013-06-01 00:00:01".
+# Instead of creating a datetime object for every row, we convert these strings to integer epoch seconds and back.
+# The times carry no time zone, so we simply treat them as UTC, which also means that there are no daylight saving gaps.
+time_format = '%Y-%m-%d %H:%M:%S'
+
+# The proleptic Gregorian ordinal of the epoch, used to convert between ordinals and epoch days.
+epoch_ordinal = date(1970, 1, 1).toordinal()
+
+# The data only spans a few hundred days, so we cache the epoch seconds of each date and the string of each epoch day.
+date_pattern = re.compile("[0-9]{4}-[0-9]{2}-[0-9]{2}$")
+_date_to_seconds = {}
+_day_to_date = {}
+
+# Lookup tables for the two digit hour, minute and second fields.
+_hours = {"%02d" % i: i * 3600 for i in range(0, 24)}
+_minutes = {"%02d" % i: i * 60 for i in range(0, 60)}
+_seconds = {"%02d" % i: i for i in range(0, 60)}
+
+# The number of days in each month of a non-leap year.
+_days_in_month = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], dtype=np.int64)
+
+# The positions of the digits and separators in the fixed format.
+_digit_positions = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_separators = [(4, ord("-")), (7, ord("-")), (10, ord(" ")), (13, ord(":")), (16, ord(":"))]
+
+
+# Convert a single time string to epoch seconds.
+# Strings that are not in the fixed format are handed to strptime, such that the accepted inputs and the raised
+# ValueErrors are exactly those of datetime.strptime(time_string, time_format).
+def parse_time(time_string):
+    try:
+        if time_string[10] == " " and time_string[13] == ":" and time_string[16] == ":" and len(time_string) == 19:
+            return _date_to_seconds[time_string[:10]] + _hours[time_string[11:13]] + \
+                   _minutes[time_string[14:16]] + _seconds[time_string[17:19]]
+    except (KeyError, IndexError):
+        pass
+
+    # Slow path, which also fills the date cache for the next time we encounter the same date.
+    timestamp = calendar.timegm(datetime.strptime(time_string, time_format).timetuple())
+    if date_pattern.match(time_string[:10]):
+        _date_to_seconds[time_string[:10]] = timestamp - timestamp % 86400
+    return timestamp
+
+
+# Convert a whole column of time strings to an int64 array of epoch seconds.
+# The column can be a list, or a numpy array of strings or objects.
+def parse_times(time_strings):
+    timestamps, faulty = try_parse_times(time_strings)
+    if faulty.any():
+        # Raise the same error as the scalar path does.
+        parse_time(np.asarray(time_strings, dtype=str).reshape(-1)[np.argmax(faulty)])
+    return timestamps
+
+
+# Convert a whole column of time strings to epoch seconds, and mark the entries that are not valid times.
+# The entries in the fixed format are converted as a whole, while all other entries are left to the scalar path.
+def try_parse_times(time_strings):
+    strings = np.asarray(time_strings, dtype=str).reshape(-1)
+    width = strings.dtype.itemsize // 4
+    timestamps = np.zeros(len(strings), dtype=np.int64)
+    irregular = np.ones(len(strings), dtype=bool)
+
+    if len(strings) > 0 and width >= 19:
+        characters = strings.view(np.uint32).reshape(-1, width)
+        timestamps, is_valid = parse_time_characters(characters[:, :19])
+        irregular = ~is_valid | (characters[:, 19:] != 0).any(axis=1)
+
+    faulty = np.zeros(len(strings), dtype=bool)
+    for i in np.flatnonzero(irregular).tolist():
+        try:
+            timestamps[i] = parse_time(strings[i])
+        except ValueError:
+            faulty[i] = True
+    return timestamps, faulty
+
+
+# Convert a matrix with one fixed format time per row, given as character codes, to epoch seconds.
+# Returns the epoch seconds, and a mask of the rows that are valid times in the fixed format.
+def parse_time_characters(characters):
+    is_valid = np.ones(len(characters), dtype=bool)
+    for position, separator in _separators:
+        is_valid &= characters[:, position] == separator
+
+    digits = characters[:, _digit_positions].astype(np.int64) - ord("0")
+    is_valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+
+    # Validate the fields in the same way as the datetime constructor does.
+    is_valid &= (month >= 1) & (month <= 12) & (year >= 1) & (hour <= 23) & (minute <= 59) & (second <= 59)
+    month = np.where(is_valid, month, 1)
+    is_leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    is_valid &= (day >= 1) & (day <= _days_in_month[month - 1] + ((month == 2) & is_leap))
+
+    # Count the days since the epoch, using a calendar in which the year starts in March.
+    y = year - (month <= 2)
+    era = y // 400
+    year_of_era = y - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+
+    return days * 86400 + hour * 3600 + minute * 60 + second, is_valid
+
+
+# Convert epoch seconds back to a string in the fixed format, equal to what strftime(time_format) gives.
+def format_time(timestamp):
+    day, seconds = divmod(int(timestamp), 86400)
+    date_string = _day_to_date.get(day)
+    if date_string is None:
+        date_string = date.fromordinal(day + epoch_ordinal).strftime('%Y-%m-%d')
+        _day_to_date[day] = date_string
+
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%s %02d:%02d:%02d" % (date_string, hours, minutes, seconds)
@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+# The stages that handle many files, or many months, hand them to a pool of worker processes, of which the number is
+# set here for all of them.
+
+# The number of worker processes that handle files at the same time.
+# Each worker handles one file (or one part of a file) at a time, and with a single worker everything is processed in
+# this process instead.
+number_of_workers = os.cpu_count()
+
+
+# Call the function for each of the arguments, on a pool of worker processes if we have more than one worker.
+# The results are returned in the order of the arguments.
+def process_in_parallel(function, arguments):
+    if number_of_workers <= 1:
+        return [function(argument) for argument in arguments]
+
+    with multiprocessing.Pool(number_of_workers) as pool:
+        return pool.map(function, arguments, chunksize=1)